@@ -0,0 +1,89 @@
+"""
+Compare the raw bytes scanner used by `clean-empty-columns archive` with the previous xmltodict row callback.
+
+    python benchmarks/clean_xml_scan.py [--rows ROWS] [--columns COLUMNS] [--empty EMPTY]
+"""
+
+from argparse import ArgumentParser
+from pathlib import Path
+from random import Random
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+from xmltodict import ParsingInterrupted
+from xmltodict import parse as parse_xml
+
+from convert_qa.clean_empty_columns.main import xml_empty_columns
+
+
+def write_table(path: Path, rows: int, columns: int, empty: float, seed: int = 0) -> list[str]:
+    random = Random(seed)
+    empty_columns: set[int] = set(random.sample(range(1, columns + 1), round(columns * empty)))
+
+    with path.open("w", encoding="utf-8") as fh:
+        fh.write('<?xml version="1.0" encoding="UTF-8" ?>\n')
+        fh.write('<table xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">\n')
+        for _ in range(rows):
+            fh.write("<row>")
+            for c in range(1, columns + 1):
+                if c in empty_columns:
+                    fh.write(f'<c{c} xsi:nil="true"/>' if random.random() < 0.5 else f"<c{c}></c{c}>")
+                else:
+                    fh.write(f"<c{c}>{random.randbytes(random.randint(1, 30)).hex()}</c{c}>")
+            fh.write("</row>\n")
+        fh.write("</table>")
+
+    return [f"c{c}" for c in range(1, columns + 1)]
+
+
+def xmltodict_empty_columns(path: Path, columns: list[str]) -> set[str]:
+    empty_columns: set[str] = set(columns)
+
+    def callback(_, row):
+        _empty_columns: list[str] = []
+
+        for col_id in empty_columns:
+            value = row[col_id]
+            if isinstance(value, dict):
+                if value.get("@xsi:nil", None) != "true":
+                    _empty_columns.append(col_id)
+            elif value:
+                _empty_columns.append(col_id)
+
+        empty_columns.difference_update(_empty_columns)
+
+        return len(empty_columns) > 0
+
+    try:
+        with path.open("rb") as fh:
+            parse_xml(fh, item_depth=2, item_callback=callback)
+    except ParsingInterrupted:
+        pass
+
+    return empty_columns
+
+
+def main():
+    parser = ArgumentParser("clean_xml_scan", description=__doc__)
+    parser.add_argument("--rows", type=int, default=100_000)
+    parser.add_argument("--columns", type=int, default=30)
+    parser.add_argument("--empty", type=float, default=0.2, help="ratio of empty columns")
+    args = parser.parse_args()
+
+    with TemporaryDirectory() as tmp:
+        path: Path = Path(tmp, "table1.xml")
+        columns: list[str] = write_table(path, args.rows, args.columns, args.empty)
+        size: int = path.stat().st_size
+        results: list[set[str]] = []
+
+        for name, func in (("xmltodict", xmltodict_empty_columns), ("bytes", xml_empty_columns)):
+            t: float = perf_counter()
+            results.append(func(path, columns))
+            t = perf_counter() - t
+            print(f"{name:<10} {t:>8.3f}s {size / t / 1_000_000:>8.1f}MB/s {args.rows / t:>12.0f}rows/s")
+
+        assert results[0] == results[1], f"results differ: {results[0]} != {results[1]}"
+
+
+if __name__ == "__main__":
+    main()
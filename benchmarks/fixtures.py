@@ -0,0 +1,230 @@
+"""
+Generate deterministic synthetic archives, SQLite databases and document folders to run the tools against.
+
+    python benchmarks/fixtures.py OUTPUT [--tables TABLES] [--rows ROWS] [--columns COLUMNS] [--empty EMPTY]
+                                         [--empty-tables EMPTY_TABLES] [--missing-keys MISSING_KEYS]
+                                         [--duplicates DUPLICATES] [--control CONTROL] [--documents DOCUMENTS]
+                                         [--seed SEED]
+"""
+
+from argparse import ArgumentParser
+from dataclasses import asdict
+from dataclasses import dataclass
+from json import dumps
+from pathlib import Path
+from random import Random
+from sqlite3 import Connection
+from sqlite3 import connect
+from typing import Optional
+from typing import TextIO
+
+# The bytes removed by remove-control-characters
+control_bytes: list[int] = [*range(0, 7), 11, *range(14, 27), *range(28, 32)]
+
+
+@dataclass
+class FixtureOptions:
+    tables: int = 10
+    rows: int = 10_000
+    columns: int = 10
+    empty: float = 0.2  # ratio of empty columns in each table
+    empty_tables: float = 0.1  # ratio of tables without rows
+    missing_keys: float = 0.5  # ratio of tables without a primary key
+    duplicates: float = 0.1  # ratio of duplicated rows in each table
+    control: float = 0.001  # ratio of values with a control character
+    documents: int = 1_000  # documents for convert-compare
+    seed: int = 0
+
+
+@dataclass
+class Fixture:
+    path: Path
+    rows: int
+    size: int
+
+
+def value(random: Random, options: FixtureOptions) -> str:
+    text: str = random.choice(("Aarhus", "Kommune", "Sag", "Akt", "Bygning", "Vej", "Æble", "Øst", "Århus"))
+    text += f" {random.randint(0, 1_000_000)}"
+    if random.random() < options.control:
+        position: int = random.randint(0, len(text))
+        text = text[:position] + chr(random.choice(control_bytes)) + text[position:]
+    return text
+
+
+def table_rows(random: Random, options: FixtureOptions, columns: int, empty_columns: set[int]
+               ) -> list[list[Optional[str]]]:
+    rows: list[list[Optional[str]]] = []
+    for _ in range(options.rows):
+        if rows and random.random() < options.duplicates:
+            rows.append(random.choice(rows))
+        else:
+            rows.append([None if c in empty_columns else value(random, options) for c in range(1, columns + 1)])
+    return rows
+
+
+def xml_escape(text: str) -> str:
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+
+# noinspection HttpUrlsUsage
+def write_table_xml(fh: TextIO, index: int, rows: list[list[Optional[str]]]):
+    fh.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+    fh.write(f'<table xsi:schemaLocation="http://www.sa.dk/xmlns/siard/1.0/schema0/table{index}.xsd '
+             f'table{index}.xsd" xmlns="http://www.sa.dk/xmlns/siard/1.0/schema0/table{index}.xsd" '
+             'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">\n')
+    for row in rows:
+        fh.write("  <row>")
+        for c, v in enumerate(row, 1):
+            fh.write(f'<c{c} xsi:nil="true"/>' if v is None else f"<c{c}>{xml_escape(v)}</c{c}>")
+        fh.write("</row>\n")
+    fh.write("</table>\n")
+
+
+# noinspection HttpUrlsUsage
+def write_table_xsd(fh: TextIO, index: int, columns: int):
+    fh.write('<?xml version="1.0" encoding="utf-8"?>\n')
+    fh.write('<xs:schema xmlns:xs="http://www.w3.org/2001/XMLSchema" '
+             f'xmlns="http://www.sa.dk/xmlns/siard/1.0/schema0/table{index}.xsd" '
+             'attributeFormDefault="unqualified" elementFormDefault="qualified" '
+             f'targetNamespace="http://www.sa.dk/xmlns/siard/1.0/schema0/table{index}.xsd">')
+    fh.write('<xs:element name="table"><xs:complexType><xs:sequence>'
+             '<xs:element minOccurs="0" maxOccurs="unbounded" name="row" type="rowType"></xs:element>'
+             '</xs:sequence></xs:complexType></xs:element>')
+    fh.write('<xs:complexType name="rowType"><xs:sequence>')
+    for c in range(1, columns + 1):
+        fh.write(f'<xs:element minOccurs="1" name="c{c}" type="xs:string" nillable="true"></xs:element>')
+    fh.write("</xs:sequence></xs:complexType></xs:schema>")
+
+
+def write_archive(path: Path, options: FixtureOptions) -> Fixture:
+    """
+    Write an archive with an Indices/tableIndex.xml file and a tables/tableN folder with XML and XSD files per table.
+    """
+    random = Random(options.seed)
+    path.joinpath("Indices").mkdir(parents=True, exist_ok=True)
+    tables_index: list[str] = []
+    total_rows: int = 0
+
+    for index in range(1, options.tables + 1):
+        empty_columns: set[int] = set(random.sample(range(1, options.columns + 1),
+                                                    round(options.columns * options.empty)))
+        rows: list[list[Optional[str]]] = [] if random.random() < options.empty_tables else \
+            table_rows(random, options, options.columns, empty_columns)
+        missing_key: bool = random.random() < options.missing_keys
+        total_rows += len(rows)
+
+        table_folder: Path = path.joinpath("tables", f"table{index}")
+        table_folder.mkdir(parents=True, exist_ok=True)
+        with table_folder.joinpath(f"table{index}.xml").open("w", encoding="utf-8", newline="\n") as fh:
+            write_table_xml(fh, index, rows)
+        with table_folder.joinpath(f"table{index}.xsd").open("w", encoding="utf-8", newline="\n") as fh:
+            write_table_xsd(fh, index, options.columns)
+
+        tables_index.append(
+            f"<table><name>T{index}</name><folder>table{index}</folder><description>Table {index}</description>"
+            "<columns>" +
+            "".join(f"<column><name>col{c}</name><columnID>c{c}</columnID><type>VARCHAR(100)</type>"
+                    f"<nullable>true</nullable><description>Column {c}</description></column>"
+                    for c in range(1, options.columns + 1)) +
+            "</columns>"
+            f"<primaryKey><name>{'MISSING' if missing_key else f'pk_T{index}'}</name>"
+            f"<column>{'MISSING' if missing_key else 'col1'}</column></primaryKey>"
+            f"<rows>{len(rows)}</rows></table>"
+        )
+
+    path.joinpath("Indices", "tableIndex.xml").write_text(
+        '<?xml version="1.0" encoding="utf-8"?>\n'
+        '<siardDiark xmlns="http://www.sa.dk/xmlns/diark/1.0" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">'
+        "<version>1.0</version><dbName>benchmark</dbName><databaseProduct>convert-qa</databaseProduct>"
+        f"<tables>{''.join(tables_index)}</tables></siardDiark>",
+        "utf-8"
+    )
+
+    return Fixture(path, total_rows, sum(f.stat().st_size for f in path.rglob("*") if f.is_file()))
+
+
+# noinspection SqlNoDataSourceInspection
+def write_sqlite(path: Path, options: FixtureOptions) -> Fixture:
+    """
+    Write a SQLite database with one table per archive table, with the same empty columns and duplicate rows.
+    """
+    random = Random(options.seed)
+    path.unlink(missing_ok=True)
+    conn: Connection = connect(path)
+    total_rows: int = 0
+
+    try:
+        for index in range(1, options.tables + 1):
+            empty_columns: set[int] = set(random.sample(range(1, options.columns + 1),
+                                                        round(options.columns * options.empty)))
+            rows: list[list[Optional[str]]] = [] if random.random() < options.empty_tables else \
+                table_rows(random, options, options.columns, empty_columns)
+            total_rows += len(rows)
+            columns: list[str] = [f"col{c}" for c in range(1, options.columns + 1)]
+            conn.execute(f"create table t{index} ({', '.join(f'{c} text' for c in columns)})")
+            conn.executemany(f"insert into t{index} values ({', '.join('?' * len(columns))})", rows)
+        conn.commit()
+    finally:
+        conn.close()
+
+    return Fixture(path, total_rows, path.stat().st_size)
+
+
+# noinspection SqlNoDataSourceInspection
+def write_documents(path: Path, options: FixtureOptions) -> tuple[Fixture, Fixture]:
+    """
+    Write an original and a master folder of documents, with the _metadata/files.db database of the originals.
+    """
+    random = Random(options.seed)
+    original: Path = path.joinpath("original")
+    master: Path = path.joinpath("master")
+    original.joinpath("_metadata").mkdir(parents=True, exist_ok=True)
+    master.mkdir(parents=True, exist_ok=True)
+    files: list[tuple[str, str, int]] = []
+    puids: list[tuple[str, str]] = [(f"fmt/{n}", s) for n, s in enumerate((".pdf", ".doc", ".tif", ".jpg", ".xls"))]
+
+    for n in range(1, options.documents + 1):
+        puid, suffix = random.choice(puids)
+        relative_path: str = f"docCollection1/{n}/{n}{suffix}"
+        data: bytes = random.randbytes(random.randint(1_000, 100_000))
+        original.joinpath(relative_path).parent.mkdir(parents=True, exist_ok=True)
+        original.joinpath(relative_path).write_bytes(data)
+        master.joinpath(relative_path).parent.mkdir(parents=True, exist_ok=True)
+        master.joinpath(relative_path).with_suffix(".pdf").write_bytes(data)
+        files.append((relative_path, puid, len(data)))
+
+    conn: Connection = connect(original.joinpath("_metadata", "files.db"))
+    try:
+        conn.execute("create table Files (id integer primary key, relative_path text, puid text, "
+                     "file_size_in_bytes integer, is_binary boolean)")
+        conn.executemany("insert into Files (relative_path, puid, file_size_in_bytes, is_binary) values (?, ?, ?, 1)",
+                         files)
+        conn.commit()
+    finally:
+        conn.close()
+
+    return (Fixture(original, len(files), sum(s for _, _, s in files)),
+            Fixture(master, len(files), sum(s for _, _, s in files)))
+
+
+def main():
+    parser = ArgumentParser("fixtures", description=__doc__)
+    parser.add_argument("output", type=Path, help="the folder to write the fixtures in")
+    for field, default in asdict(FixtureOptions()).items():
+        parser.add_argument(f"--{field.replace('_', '-')}", type=type(default), default=default)
+    args = parser.parse_args()
+    options = FixtureOptions(**{f: getattr(args, f) for f in asdict(FixtureOptions())})
+
+    args.output.mkdir(parents=True, exist_ok=True)
+    fixtures: dict[str, Fixture] = {
+        "archive": write_archive(args.output.joinpath("archive"), options),
+        "sqlite": write_sqlite(args.output.joinpath("database.sqlite"), options),
+    }
+    fixtures["original"], fixtures["master"] = write_documents(args.output.joinpath("documents"), options)
+
+    print(dumps({n: {"path": str(f.path), "rows": f.rows, "size": f.size} for n, f in fixtures.items()}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
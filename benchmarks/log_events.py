@@ -0,0 +1,60 @@
+"""
+Compare the buffered log writer used by all tools with the previous print_with_file, which opened the log file again
+for every event.
+
+    python benchmarks/log_events.py [--events EVENTS]
+"""
+
+from argparse import ArgumentParser
+from contextlib import redirect_stdout
+from datetime import datetime
+from os import devnull
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from typing import Optional
+
+from convert_qa.common.main import log_writers_close
+from convert_qa.common.main import print_with_file
+
+
+def print_with_file_unbuffered(log_file: Optional[Path]):
+    if log_file:
+        def inner(*args, **kwargs):
+            print(*args, **kwargs)
+            print(datetime.now().isoformat().strip(), (kwargs.get("sep", " ").join(map(str, args)).strip()),
+                  file=log_file.open("a"))
+    else:
+        def inner(*args, **kwargs):
+            print(*args, **kwargs)
+
+    return inner
+
+
+def main():
+    parser = ArgumentParser("log_events", description=__doc__)
+    parser.add_argument("--events", type=int, default=100_000)
+    args = parser.parse_args()
+
+    with TemporaryDirectory() as tmp, open(devnull, "w") as null:
+        for name, factory, log_file in (("unbuffered", print_with_file_unbuffered, Path(tmp, "unbuffered.log")),
+                                        ("text", print_with_file, Path(tmp, "text.log")),
+                                        ("jsonl", print_with_file, Path(tmp, "events.jsonl"))):
+            echo = factory(log_file)
+            t: float = perf_counter()
+            with redirect_stdout(null):
+                for n in range(args.events):
+                    if factory is print_with_file_unbuffered:
+                        echo(f"file.txt/{n}/00")
+                    else:
+                        echo(f"file.txt/{n}/00",
+                             event={"file": "file.txt", "offset": n, "action": "control character"})
+                log_writers_close()
+            t = perf_counter() - t
+            lines: int = len(log_file.read_text("utf-8").splitlines())
+            print(f"{name:<10} {t:>8.3f}s {args.events / t:>12.0f}events/s")
+            assert lines == args.events, f"{name}: {lines} lines written instead of {args.events}"
+
+
+if __name__ == "__main__":
+    main()
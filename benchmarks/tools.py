@@ -0,0 +1,198 @@
+"""
+Run every command of convert-qa against synthetic fixtures and report rows/s, MB/s and the peak memory of each run.
+
+The fixtures are generated once and copied before each run, as most commands change their input. The results are
+written as JSON, and can be compared with the results of an earlier run.
+
+    python benchmarks/tools.py [--output OUTPUT] [--compare COMPARE] [--tool TOOL [TOOL ...]] [--repeat REPEAT]
+                               [--jobs JOBS] [fixture options, see fixtures.py]
+"""
+
+from argparse import ArgumentParser
+from dataclasses import asdict
+from datetime import datetime
+from json import dumps
+from json import loads
+from os import devnull
+from os import waitstatus_to_exitcode
+from pathlib import Path
+from platform import platform
+from platform import python_version
+from shutil import copy2
+from shutil import copytree
+from shutil import rmtree
+from subprocess import DEVNULL
+from subprocess import Popen
+from subprocess import run
+from sys import executable
+from sys import platform as sys_platform
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from typing import Callable
+from typing import Optional
+
+from fixtures import Fixture
+from fixtures import FixtureOptions
+from fixtures import write_archive
+from fixtures import write_documents
+from fixtures import write_sqlite
+
+try:
+    from os import wait4
+except ImportError:  # not available on Windows
+    wait4 = None
+
+
+# The command, its entry point, the fixtures it reads, and its arguments given the copied fixtures, a log file and jobs
+tools: list[tuple[str, str, list[str], Callable[[dict[str, Path], Path, int], list[str]]]] = [
+    ("clean-empty-columns archive", "convert_qa.clean_empty_columns.main:cli", ["archive"],
+     lambda f, log, jobs: ["archive", str(f["archive"]), "--commit", "--jobs", str(jobs), "--log-file", str(log)]),
+    ("clean-empty-columns sqlite", "convert_qa.clean_empty_columns.main:cli", ["sqlite"],
+     lambda f, log, jobs: ["sqlite", str(f["sqlite"]), "--commit", "--log-file", str(log)]),
+    ("remove-tables", "convert_qa.remove_tables.main:cli", ["archive"],
+     lambda f, log, jobs: [str(f["archive"]), "--empty-tables", "--jobs", str(jobs), "--log-file", str(log)]),
+    ("add-primary-keys", "convert_qa.add_primary_keys.main:cli", ["archive"],
+     lambda f, log, jobs: [str(f["archive"]), "--jobs", str(jobs), "--log-file", str(log)]),
+    ("process-archive", "convert_qa.process_archive.main:cli", ["archive"],
+     lambda f, log, jobs: [str(f["archive"]), "--remove-empty-tables", "--clean-empty-columns", "--add-primary-keys",
+                           "--commit", "--jobs", str(jobs), "--log-file", str(log)]),
+    ("remove-control-characters", "convert_qa.remove_control_characters.main:cli", ["tables"],
+     lambda f, log, jobs: [*map(str, sorted(f["tables"].glob("*.xml"))), "--commit", "--jobs", str(jobs),
+                           "--log-file", str(log)]),
+    ("remove-duplicate-rows", "convert_qa.remove_duplicate_rows.main:cli", ["sqlite"],
+     lambda f, log, jobs: [str(f["sqlite"]), "--commit", "--log-file", str(log)]),
+    ("convert-encoding", "convert_qa.encoding.main:cli", ["archive"],
+     lambda f, log, jobs: [str(f["archive"]), "--jobs", str(jobs)]),
+    ("convert-compare", "convert_qa.compare.main:main", ["original", "master"],
+     lambda f, log, jobs: ["--original", str(f["original"]), "--master", str(f["master"]),
+                           "--output", str(log.with_name("comparison_output")), "--jobs", str(jobs)]),
+]
+
+
+def run_tool(entry_point: str, name: str, args: list[str], cwd: Path) -> tuple[float, Optional[int], int]:
+    """
+    Run an entry point in a new interpreter and return its wall time, the peak resident memory of its main process in
+    bytes (None where it cannot be measured) and its return code.
+    """
+    module, function = entry_point.split(":")
+    command: list[str] = [
+        executable,
+        "-c",
+        f"import sys; sys.argv[0] = {name.split()[0]!r}; from {module} import {function}; {function}()",
+        *args,
+    ]
+
+    with open(devnull, "w") as null:
+        start: float = perf_counter()
+        process = Popen(command, cwd=cwd, stdout=null, stderr=DEVNULL)
+        if wait4:
+            _, status, usage = wait4(process.pid, 0)
+            process.returncode = waitstatus_to_exitcode(status)
+            # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+            peak_rss: Optional[int] = usage.ru_maxrss * (1 if sys_platform == "darwin" else 1024)
+        else:
+            process.wait()
+            peak_rss = None
+        seconds: float = perf_counter() - start
+
+    return seconds, peak_rss, process.returncode
+
+
+def copy_fixture(path: Path, to: Path) -> Path:
+    if path.is_dir():
+        return Path(copytree(path, to))
+    return Path(copy2(path, to))
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+                   cwd=Path(__file__).parent).stdout.strip()
+    except Exception:
+        return None
+
+
+def main():
+    parser = ArgumentParser("tools", description=__doc__)
+    parser.add_argument("--output", type=Path, default=None, help="write the results to a JSON file")
+    parser.add_argument("--compare", type=Path, default=None, help="compare with the results of an earlier run")
+    parser.add_argument("--tool", nargs="+", default=[], help="only run the commands starting with these names")
+    parser.add_argument("--repeat", type=int, default=1, help="number of runs per command, the fastest is reported")
+    parser.add_argument("--jobs", type=int, default=1, help="jobs for the commands that support them")
+    for field, default in asdict(FixtureOptions()).items():
+        parser.add_argument(f"--{field.replace('_', '-')}", type=type(default), default=default)
+    args = parser.parse_args()
+    options = FixtureOptions(**{f: getattr(args, f) for f in asdict(FixtureOptions())})
+
+    previous: dict[str, dict] = {r["tool"]: r for r in loads(args.compare.read_text())["results"]} \
+        if args.compare else {}
+    results: list[dict] = []
+    root: Path = Path(__file__).parent.parent.resolve()
+
+    with TemporaryDirectory() as tmp:
+        fixtures_folder: Path = Path(tmp, "fixtures")
+        fixtures: dict[str, Fixture] = {
+            "archive": write_archive(fixtures_folder.joinpath("archive"), options),
+            "sqlite": write_sqlite(fixtures_folder.joinpath("database.sqlite"), options),
+        }
+        fixtures["original"], fixtures["master"] = write_documents(fixtures_folder.joinpath("documents"), options)
+        fixtures["tables"] = Fixture(fixtures_folder.joinpath("tables"), fixtures["archive"].rows, 0)
+        fixtures["tables"].path.mkdir()
+        for table in fixtures["archive"].path.joinpath("tables").glob("*/*.xml"):
+            copy2(table, fixtures["tables"].path)
+            fixtures["tables"].size += table.stat().st_size
+
+        print(f"{'Command':<28} {'Seconds':>9} {'Rows/s':>12} {'MB/s':>9} {'Peak MB':>9} {'Change':>8}")
+
+        for name, entry_point, inputs, arguments in tools:
+            if args.tool and not any(name.startswith(t) for t in args.tool):
+                continue
+
+            rows: int = fixtures[inputs[0]].rows
+            size: int = sum(fixtures[i].size for i in inputs)
+            runs: list[tuple[float, Optional[int], int]] = []
+
+            for _ in range(args.repeat):
+                work: Path = Path(tmp, "work")
+                rmtree(work, ignore_errors=True)
+                work.mkdir()
+                copies: dict[str, Path] = {i: copy_fixture(fixtures[i].path, work.joinpath(fixtures[i].path.name))
+                                           for i in inputs}
+                runs.append(run_tool(entry_point, name, arguments(copies, work.joinpath("log.txt"), args.jobs), root))
+
+            seconds, peak_rss, returncode = min(runs, key=lambda r: r[0])
+            result: dict = {
+                "tool": name,
+                "seconds": seconds,
+                "runs": [r[0] for r in runs],
+                "rows": rows,
+                "bytes": size,
+                "rows_per_second": rows / seconds,
+                "mb_per_second": size / 1_000_000 / seconds,
+                "peak_rss": max((r[1] for r in runs if r[1] is not None), default=None),
+                "returncode": returncode,
+            }
+            results.append(result)
+
+            change: str = f"{previous[name]['seconds'] / seconds:.2f}x" if name in previous else ""
+            peak: str = f"{result['peak_rss'] / 1_000_000:.1f}" if result["peak_rss"] is not None else "-"
+            print(f"{name:<28} {seconds:>9.3f} {result['rows_per_second']:>12.0f} {result['mb_per_second']:>9.2f} "
+                  f"{peak:>9} {change:>8}" + (f" (exit code {returncode})" if returncode else ""))
+
+    report: dict = {
+        "time": datetime.now().isoformat(),
+        "commit": git_commit(),
+        "python": python_version(),
+        "platform": platform(),
+        "jobs": args.jobs,
+        "repeat": args.repeat,
+        "options": asdict(options),
+        "results": results,
+    }
+
+    if args.output:
+        args.output.write_text(dumps(report, indent=2), "utf-8")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,25 +1,49 @@
 from argparse import ArgumentParser
+from concurrent.futures import Future
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain
 from pathlib import Path
+from sqlite3 import Connection
+from typing import Callable
 from typing import Optional
 
 from xmltodict import parse as parse_xml
 from xmltodict import unparse as unparse_xml
 
-from ..clean_empty_columns.main import print_with_file
+from ..clean_empty_columns.main import column_start
+from ..clean_empty_columns.main import table_cache_connect
+from ..clean_empty_columns.main import table_cache_get
+from ..clean_empty_columns.main import table_cache_path
+from ..clean_empty_columns.main import table_cache_update
+from ..clean_empty_columns.main import table_xml_body_start
+from ..clean_empty_columns.main import table_xml_header
+from ..clean_empty_columns.main import table_xml_rewrite_rows
+from ..common.main import Progress
+from ..common.main import print_with_file
+from ..common.main import profile
+from ..common.main import profile_arguments
+from ..common.main import timed_call
+
+
+def xsd_add_key(xsd: dict) -> dict:
+    """
+    Add a key column at the end of the columns of a parsed table XSD.
+    """
+    xsd["xs:schema"][0]["xs:complexType"][0]["xs:sequence"][0]["xs:element"].append({
+        "@minOccurs": "1",
+        "@name": f'c{len(xsd["xs:schema"][0]["xs:complexType"][0]["xs:sequence"][0]["xs:element"]) + 1}',
+        "@nillable": "false",
+        "@type": "xs:integer"
+    })
+
+    return xsd
 
 
 def table_xsd_add_key(path: Path, out_path: Optional[Path] = None) -> Path:
     out_path = out_path or path.with_suffix(".new" + path.suffix)
 
     with path.open("rb") as fi:
-        xsd = parse_xml(fi, "utf-8", force_list=True)
-
-        xsd["xs:schema"][0]["xs:complexType"][0]["xs:sequence"][0]["xs:element"].append({
-            "@minOccurs": "1",
-            "@name": f'c{len(xsd["xs:schema"][0]["xs:complexType"][0]["xs:sequence"][0]["xs:element"]) + 1}',
-            "@nillable": "false",
-            "@type": "xs:integer"
-        })
+        xsd = xsd_add_key(parse_xml(fi, "utf-8", force_list=True))
 
         with out_path.open("wb") as fo:
             unparse_xml(xsd, fo, "utf-8")
@@ -27,79 +51,172 @@ def table_xsd_add_key(path: Path, out_path: Optional[Path] = None) -> Path:
     return out_path
 
 
-# noinspection HttpUrlsUsage
-def table_xml_add_key(path: Path, index: int, out_path: Optional[Path] = None) -> Path:
+def rows_add_key(key_column: str) -> Callable[[bytes], bytes]:
+    """
+    Get a function that adds a key column with incrementing values (starting at 1) to chunks of complete rows.
+
+    The new element is inserted before each `</row>`, the rows are otherwise kept byte for byte.
+    """
+    key_open: bytes = f"<{key_column}>".encode()
+    key_close: bytes = f"</{key_column}></row>".encode()
+    key: int = 1
+
+    def rewrite(rows: bytes) -> bytes:
+        nonlocal key
+        parts: list[bytes] = rows.split(b"</row>")
+        keys: list[bytes] = [key_open + str(k).encode() + key_close for k in range(key, key + len(parts) - 1)]
+        key += len(keys)
+        return b"".join(chain.from_iterable(zip(parts, keys + [b""])))
+
+    return rewrite
+
+
+def table_xml_add_key(path: Path, index: int, out_path: Optional[Path] = None, key_column: Optional[str] = None,
+                      chunk_size: int = 1_000_000) -> Path:
+    """
+    Add a key column with incrementing values (starting at 1) at the end of every row of a table XML file.
+
+    If key_column is not given, it is named after the number of columns in the first row.
+    """
     out_path = out_path or path.with_suffix(".new" + path.suffix)
 
     with path.open("rb") as fi:
-        with out_path.open("w", encoding="utf-8") as fo:
-            fo.write('<?xml version="1.0" encoding="UTF-8" ?>\n')
-            fo.write(
-                f'<table '
-                f'xsi:schemaLocation="http://www.sa.dk/xmlns/siard/1.0/schema0/table{index}.xsd ./table{index}.xsd" '
-                f'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" '
-                f'xmlns="http://www.sa.dk/xmlns/siard/1.0/schema0/table{index}.xsd">\n')
-
-            key_index: dict[str, int] = {"k": 1}
-
-            def callback(_, row: dict):
-                row[f"c{len(row) + 1}"] = key_index["k"]
-                key_index["k"] = key_index["k"] + 1
-                unparse_xml({"row": row}, fo, "utf-8", full_document=False)
-                fo.write("\n")
-                return True
-
-            parse_xml(fi, item_depth=2, item_callback=callback, force_list=True)
-            fo.write('</table>')
+        if key_column is None:
+            start: int = table_xml_body_start(fi, chunk_size)
+            fi.seek(max(start, 0))
+            first_row: bytes = fi.read(chunk_size).split(b"</row>", 1)[0] if start >= 0 else b""
+            key_column = f"c{len(set(column_start.findall(first_row))) + 1}"
 
-    return out_path
+        with out_path.open("wb", buffering=chunk_size * 10) as fo:
+            fo.write(table_xml_header(index))
+            table_xml_rewrite_rows(fi, fo, rows_add_key(key_column), chunk_size)
 
+    return out_path
 
-def main(archive: Path, log_file: Path):
-    echo = print_with_file(log_file)
 
-    tables_index_path: Path = archive.joinpath("Indices", "tableIndex.xml")
-    tables_index: dict = parse_xml(tables_index_path.read_text("utf-8"), force_list=True)
-    tables: list[dict] = tables_index["siardDiark"][0]["tables"][0]["table"]
-    tables_new: list[dict] = []
+def table_add_key(table_folder: Path, index: int, key_column: str):
+    """
+    Add a key column to the XML and XSD files of a table.
+    """
+    xml_path: Path = table_folder.joinpath(table_folder.name).with_suffix(".xml")
+    xml_path_tmp = table_xml_add_key(xml_path, index, xml_path.with_name("." + xml_path.name), key_column)
+    xml_path_tmp.replace(xml_path)
 
-    for table in tables:
-        if table["primaryKey"][0]["name"][0].lower() != "missing":
-            tables_new.append(table)
-            continue
+    xsd_path: Path = xml_path.with_suffix(".xsd")
+    xsd_path_tmp = table_xsd_add_key(xsd_path, xsd_path.with_name("." + xsd_path.name))
+    xsd_path_tmp.replace(xsd_path)
 
-        index: int = int(table["folder"][0].removeprefix("table"))
-        table_folder: Path = archive.joinpath("tables", table["folder"][0])
 
-        print(f"{archive.name}/{table['folder'][0]}/adding key... ", end="", flush=True)
+def table_index_add_key(table: dict) -> dict:
+    """
+    Add a key column at the end of the columns of a table from a parsed tableIndex.xml and set it as primary key.
+    """
+    table["primaryKey"][0]["name"][0] = f"pk_{table['name'][0]}"
+    table["primaryKey"][0]["column"][0] = "aca_id__"
+    table["columns"][0]["column"].append({
+        "name": [table["primaryKey"][0]["column"][0]],
+        "columnID": [f'c{len(table["columns"][0]["column"]) + 1}'],
+        "type": ["INTEGER"],
+        "nullable": ["false"],
+        "description": ["Primær nøgle genereret af Aarhus stadsarkiv"],
+    })
 
-        xml_path: Path = table_folder.joinpath(table["folder"][0]).with_suffix(".xml")
-        xml_path_tmp = table_xml_add_key(xml_path, index, xml_path.with_name("." + xml_path.name))
-        xml_path_tmp.replace(xml_path)
+    return table
 
-        xsd_path: Path = xml_path.with_suffix(".xsd")
-        xsd_path_tmp = table_xsd_add_key(xsd_path, xsd_path.with_name("." + xsd_path.name))
-        xsd_path_tmp.replace(xsd_path)
 
-        table["primaryKey"][0]["name"][0] = f"pk_{table['name'][0]}"
-        table["primaryKey"][0]["column"][0] = "aca_id__"
-        table["columns"][0]["column"].append({
-            "name": [table["primaryKey"][0]["column"][0]],
-            "columnID": [f'c{len(table["columns"][0]["column"]) + 1}'],
-            "type": ["INTEGER"],
-            "nullable": ["false"],
-            "description": ["Primær nøgle genereret af Aarhus stadsarkiv"],
-        })
+def main(archive: Path, log_file: Path, jobs: int = 1, cache: bool = False):
+    echo = print_with_file(log_file)
 
-        tables_new.append(table)
+    tables_index_path: Path = archive.joinpath("Indices", "tableIndex.xml")
+    tables_index: dict = parse_xml(tables_index_path.read_text("utf-8"), force_list=True)
+    tables: list[dict] = tables_index["siardDiark"][0]["tables"][0]["table"]
+    tables_new: list[dict] = []
+    tables_missing: list[dict] = [t for t in tables if t["primaryKey"][0]["name"][0].lower() == "missing"]
+    executor: Optional[ProcessPoolExecutor] = ProcessPoolExecutor(jobs) if jobs > 1 else None
+    futures: dict[str, Future] = {}
+    cache_conn: Optional[Connection] = table_cache_connect(table_cache_path(archive)) if cache else None
+    tables_stats: dict[int, tuple[list[str], set[str], Optional[int]]] = {}
+
+    # Read the cached statistics of the tables before their files are changed
+    for table in (tables_missing if cache_conn else []):
+        entry = table_cache_get(cache_conn, archive.joinpath("tables", table["folder"][0], f"{table['folder'][0]}.xml"))
+        if entry:
+            tables_stats[int(table["folder"][0].removeprefix("table"))] = entry
+
+    # The sizes of the table files that exist, the others fail in their turn as without parallel jobs
+    tables_sizes: dict[str, int] = {
+        t["folder"][0]: p.stat().st_size
+        for t in tables_missing
+        for p in [archive.joinpath("tables", t["folder"][0], f"{t['folder'][0]}.xml")]
+        if p.is_file()
+    }
+    progress: Progress = Progress(sum(tables_sizes.values()))
+
+    try:
+        # Start adding keys in parallel, largest tables first
+        for table in sorted((t for t in tables_missing if t["folder"][0] in tables_sizes) if executor else [],
+                            key=lambda t: tables_sizes[t["folder"][0]], reverse=True):
+            futures[table["folder"][0]] = executor.submit(
+                timed_call,
+                table_add_key,
+                archive.joinpath("tables", table["folder"][0]),
+                int(table["folder"][0].removeprefix("table")),
+                f'c{len(table["columns"][0]["column"]) + 1}'
+            )
+
+        for table in tables:
+            if table["primaryKey"][0]["name"][0].lower() != "missing":
+                tables_new.append(table)
+                continue
+
+            index: int = int(table["folder"][0].removeprefix("table"))
+            table_folder: Path = archive.joinpath("tables", table["folder"][0])
+            key_column: str = f'c{len(table["columns"][0]["column"]) + 1}'
+
+            progress.update(f"{archive.name}/{table['folder'][0]}/adding key")
+
+            with profile.phase(f"{archive.name}/{table['folder'][0]}", "rewrite") as counters:
+                if table["folder"][0] in futures:
+                    _, worker_counters = futures[table["folder"][0]].result()
+                    counters.update(worker_counters)
+                else:
+                    table_add_key(table_folder, index, key_column)
+                if profile:
+                    counters["bytes_written"] = table_folder.joinpath(f"{table['folder'][0]}.xml").stat().st_size
+
+            table_index_add_key(table)
 
-        echo(f'\r{archive.name}/{table["folder"][0]}/added '
-             f'{table["columns"][0]["column"][-1]["columnID"][0]} '
-             f'{table["primaryKey"][0]["column"][0]}')
+            tables_new.append(table)
 
-    tables_index["siardDiark"][0]["tables"][0]["table"] = tables_new
-    with tables_index_path.open("wb") as fh:
-        unparse_xml(tables_index, fh, "utf-8")
+            progress.update(advance=tables_sizes.get(table["folder"][0], 0))
+            progress.clear()
+            echo(f'{archive.name}/{table["folder"][0]}/added '
+                 f'{table["columns"][0]["column"][-1]["columnID"][0]} '
+                 f'{table["primaryKey"][0]["column"][0]}',
+                 event={"file": archive.name, "table": table["folder"][0],
+                        "column": table["columns"][0]["column"][-1]["columnID"][0], "action": "added"})
+
+        progress.close()
+
+        tables_index["siardDiark"][0]["tables"][0]["table"] = tables_new
+        with profile.phase(archive.name, "index"), tables_index_path.open("wb") as fh:
+            unparse_xml(tables_index, fh, "utf-8")
+
+        if cache_conn:
+            with profile.phase(archive.name, "cache"):
+                table_cache_update(cache_conn, archive, tables_stats, [], [], tables_stats.keys())
+    except (Exception, BaseException) as err:
+        progress.close()
+        print()
+        echo("ERROR: The operation was interrupted before all changes could be written.",
+             f"Archive {archive.name} is likely corrupted.", event={"file": archive.name, "action": "error"})
+        print()
+        raise err
+    finally:
+        if executor:
+            executor.shutdown(cancel_futures=True)
+        if cache_conn:
+            cache_conn.close()
 
 
 def cli():
@@ -109,8 +226,13 @@ def cli():
 
     parser = ArgumentParser("add-primary-keys", description=cli.__doc__)
     parser.add_argument("archive", type=Path, help="the path to the archive")
+    parser.add_argument("--jobs", type=int, default=1, help="number of tables to add keys to in parallel")
+    parser.add_argument("--cache", action="store_true", required=False,
+                        help="keep the statistics cache next to the archive up to date")
     parser.add_argument("--log-file", type=Path, required=True, help="write change events to log file")
+    profile_arguments(parser)
 
     args = parser.parse_args()
+    profile.start(args.profile, args.profile_stats)
 
-    main(args.archive, args.log_file)
+    main(args.archive, args.log_file, args.jobs, args.cache)
@@ -1,17 +1,43 @@
+import os
 from argparse import ArgumentParser
+from bisect import bisect_left
+from concurrent.futures import Future
+from concurrent.futures import ProcessPoolExecutor
 from copy import deepcopy
-from datetime import datetime
 from functools import reduce
-from os import environ
+from hashlib import sha1
+from json import dumps
+from json import loads
 from pathlib import Path
+from re import Match
+from re import Pattern
+from re import compile as re_compile
 from sqlite3 import Connection
+from sqlite3 import OperationalError
 from sqlite3 import connect
+from typing import BinaryIO
+from typing import Callable
+from typing import Iterable
+from typing import Iterator
 from typing import Optional
 
-from xmltodict import ParsingInterrupted
 from xmltodict import parse as parse_xml
 from xmltodict import unparse as unparse_xml
 
+from ..common.main import Progress
+from ..common.main import file_copy_range
+from ..common.main import print_with_file
+from ..common.main import profile
+from ..common.main import profile_arguments
+from ..common.main import timed_call
+
+row_start: Pattern[bytes] = re_compile(rb"<row(?=[\s/>])")
+column_start: Pattern[bytes] = re_compile(rb"<(c\d+)(?=[\s/>])")
+# The table options (e.g. "WITHOUT ROWID, STRICT") that follow the column definitions of a create table statement
+without_rowid: Pattern[str] = re_compile(r"(?i)\)[\s\w,]*\bwithout\s+rowid\b[\s\w,]*$")
+# The event of a create trigger statement, the first of these keywords after the trigger's name
+trigger_event: Pattern[str] = re_compile(r"(?i)\b(delete|insert|update)\b")
+
 
 # noinspection SqlNoDataSourceInspection,SqlResolve
 def sqlite_get_tables(conn: Connection) -> list[str]:
@@ -41,6 +67,67 @@ def sqlite_has_value(conn: Connection, table: str, column: str) -> bool:
     ).fetchone() is not None
 
 
+# noinspection SqlNoDataSourceInspection,SqlResolve
+def sqlite_rowid_column(conn: Connection, table: str) -> Optional[str]:
+    """
+    Get the name that refers to the ROWID of a table: "rowid", or its alias "_rowid_" or "oid" if the table has a
+    column named "rowid".
+
+    Returns None if the table was created WITHOUT ROWID, as read from its schema, or if all three names are used by
+    columns of the table.
+    """
+    [table_sql] = conn.execute("select sql from sqlite_master where type = 'table' and name = ?", [table]).fetchone()
+
+    if without_rowid.search(table_sql):
+        return None
+
+    columns: set[str] = {c[1].lower() for c in conn.execute(f"pragma table_xinfo({table})")}
+    return next((name for name in ("rowid", "_rowid_", "oid") if name not in columns), None)
+
+
+# noinspection SqlNoDataSourceInspection,SqlResolve
+def sqlite_empty_columns(conn: Connection, table: str, columns: list[str], batch_size: int = 1_000,
+                         batch_size_max: int = 1_000_000) -> list[str]:
+    """
+    Find the columns of a table that have no non-empty values using a single scan of the table.
+
+    The table is read in pages of ROWIDs of growing size, each starting after the last ROWID of the previous one and
+    checked with one aggregate query for all the columns that have not yet been seen with a value. The scan stops
+    as soon as every column has a value. Tables without a ROWID are checked with a single aggregate query over the
+    whole table.
+    """
+    empty_columns: list[str] = list(columns)
+
+    def check(source: str, params: tuple = (), *aggregates: str) -> tuple:
+        values_sql: str = ", ".join([*aggregates, *(f"max({c} is not null and {c} != '')" for c in empty_columns)])
+        values = conn.execute(f"select {values_sql} from {source}", params).fetchone()
+        empty_columns[:] = [c for c, v in zip(empty_columns, values[len(aggregates):]) if not v]
+        return values[:len(aggregates)]
+
+    if not empty_columns:
+        return empty_columns
+
+    rowid: Optional[str] = sqlite_rowid_column(conn, table)
+
+    if not rowid:
+        check(table)
+        return empty_columns
+
+    last_rowid: Optional[int] = None
+
+    while empty_columns:
+        where: str = f"where {rowid} > ?" if last_rowid is not None else ""
+        page: str = (f"(select {rowid} as {rowid}, {', '.join(empty_columns)} from {table} {where} "
+                     f"order by {rowid} limit ?)")
+        rows, last_rowid = check(page, (*([] if last_rowid is None else [last_rowid]), batch_size),
+                                 "count(*)", f"max({rowid})")
+        if rows < batch_size:
+            break
+        batch_size = min(batch_size * 2, batch_size_max)
+
+    return empty_columns
+
+
 # noinspection SqlNoDataSourceInspection,SqlResolve
 def sqlite_drop_column(conn: Connection, table: str, column: str):
     """
@@ -49,6 +136,126 @@ def sqlite_drop_column(conn: Connection, table: str, column: str):
     return conn.execute(f"alter table {table} drop column {column}")
 
 
+# noinspection SqlNoDataSourceInspection,SqlResolve
+def sqlite_trigger_errors(conn: Connection) -> dict[str, str]:
+    """
+    Find the triggers of a database that cannot be compiled, with their errors.
+
+    Each trigger is compiled by preparing, without running, an explained statement of its event on its table or view.
+    Statements are cached by the connection, so the check should be run once on a connection after its schema changed.
+    """
+    errors: dict[str, str] = {}
+    # Compiling a statement can reload the schema, so the triggers are read before
+    triggers: list[tuple[str, str, str]] = conn.execute(
+        "select name, tbl_name, sql from sqlite_master where type = 'trigger'"
+    ).fetchall()
+
+    for name, table, sql in triggers:
+        event: Optional[Match[str]] = trigger_event.search(sql)
+        if event is None:
+            continue
+        elif event.group(1).lower() == "insert":
+            statement: str = f"insert into {table} default values"
+        elif event.group(1).lower() == "delete":
+            statement: str = f"delete from {table}"
+        else:
+            columns: list[str] = [c[1] for c in conn.execute(f"pragma table_info({table})")]
+            statement: str = f"update {table} set {', '.join(f'{c} = {c}' for c in columns)}"
+        try:
+            # The statement is compiled with its triggers when it is prepared, and its program is not read
+            conn.execute(f"explain {statement}").close()
+        except OperationalError as err:
+            errors[name] = str(err)
+
+    return errors
+
+
+# noinspection SqlNoDataSourceInspection,SqlResolve
+def sqlite_drop_columns(conn: Connection, table: str, columns: list[str]):
+    """
+    Drop several columns from a table by rebuilding it once with only the remaining columns.
+
+    The new table definition is obtained by dropping the columns from an empty copy of the table and its indices
+    in an in-memory copy of the schema of the database, so primary keys, constraints, defaults and indices are kept
+    exactly as SQLite itself would keep them with `alter table ... drop column`, and the columns are refused in the
+    same cases, e.g. if a trigger or a view uses them. Triggers are recreated unchanged, and the AUTOINCREMENT counter
+    of the table is kept.
+
+    Foreign keys should be disabled and `legacy_alter_table` enabled on the connection before calling.
+    """
+    tables: list[str] = [t.lower() for t in sqlite_get_tables(conn)]
+    table_tmp: str = table
+    while table_tmp.lower() in tables:
+        table_tmp = "_" + table_tmp
+
+    [table_sql] = conn.execute("select sql from sqlite_master where type = 'table' and name = ?", [table]).fetchone()
+    indices_sql: list[str] = [
+        s for [s] in
+        conn.execute("select sql from sqlite_master where type = 'index' and tbl_name = ? and sql is not null",
+                     [table])
+    ]
+    triggers_sql: list[str] = [
+        s for [s] in
+        conn.execute("select sql from sqlite_master where type = 'trigger' and tbl_name = ?", [table])
+    ]
+
+    # The triggers and views of all tables are checked against the dropped columns, so the whole schema is copied
+    schema_sql: list[str] = [
+        s for [s] in
+        conn.execute("select sql from sqlite_master where sql is not null and name not like 'sqlite\\_%' escape '\\' "
+                     "order by rowid")
+    ]
+    schema: Connection = connect(":memory:")
+
+    try:
+        for sql in schema_sql:
+            try:
+                schema.execute(sql)
+            except OperationalError:
+                # Virtual tables of modules that are not available
+                pass
+        try:
+            for column in columns:
+                sqlite_drop_column(schema, table, column)
+        except OperationalError as err:
+            raise ValueError(f"Cannot drop columns {', '.join(columns)} from table {table!r}: {err}") from err
+        # SQLite does not check the columns written by the triggers of other tables
+        triggers_errors: dict[str, str] = sqlite_trigger_errors(schema)
+        if triggers_errors:
+            raise ValueError(f"Cannot drop columns {', '.join(columns)} from table {table!r}: " +
+                             "; ".join(f"error in trigger {t}: {e}" for t, e in triggers_errors.items()))
+        indices_sql = [
+            s for [s] in
+            schema.execute("select sql from sqlite_master where type = 'index' and tbl_name = ? and sql is not null",
+                           [table])
+        ]
+        # Generated columns (hidden 2 and 3) cannot be inserted into
+        columns_new: list[str] = [c[1] for c in schema.execute(f"pragma table_xinfo({table})") if not c[6]]
+        schema.execute(f"alter table {table} rename to {table_tmp}")
+        [table_sql] = schema.execute("select sql from sqlite_master where type = 'table' and name = ?",
+                                     [table_tmp]).fetchone()
+    finally:
+        schema.close()
+
+    rowid: Optional[str] = sqlite_rowid_column(conn, table)
+    columns_sql: str = ", ".join(([rowid] if rowid else []) + columns_new)
+    # The copy would reset the AUTOINCREMENT counter to the largest ROWID left in the table
+    sequence: Optional[tuple[int]] = conn.execute(
+        "select seq from sqlite_sequence where name = ?", [table]
+    ).fetchone() if "sqlite_sequence" in sqlite_get_tables(conn) else None
+
+    conn.execute(table_sql)
+    conn.execute(f"insert into {table_tmp} ({columns_sql}) select {columns_sql} from {table}")
+    conn.execute(f"drop table {table}")
+    conn.execute(f"alter table {table_tmp} rename to {table}")
+
+    if sequence and not conn.execute("update sqlite_sequence set seq = ? where name = ?", [*sequence, table]).rowcount:
+        conn.execute("insert into sqlite_sequence (name, seq) values (?, ?)", [table, *sequence])
+
+    for sql in indices_sql + triggers_sql:
+        conn.execute(sql)
+
+
 # noinspection SqlNoDataSourceInspection,SqlResolve
 def sqlite_drop_table(conn: Connection, table: str):
     """
@@ -57,6 +264,244 @@ def sqlite_drop_table(conn: Connection, table: str):
     return conn.execute(f"drop table {table}")
 
 
+# noinspection SqlNoDataSourceInspection
+def sqlite_vacuum(conn: Connection, free_fraction: float = 0.25):
+    """
+    Reclaim the free pages of a database.
+
+    Databases with incremental vacuum enabled are vacuumed incrementally. Otherwise, a full vacuum is only run if at
+    least free_fraction of the pages of the database are free, and smaller free lists are left to be reused by later
+    writes.
+    """
+    auto_vacuum: int = conn.execute("pragma auto_vacuum").fetchone()[0]
+
+    if auto_vacuum == 1:
+        return
+    elif auto_vacuum == 2:
+        conn.execute("pragma incremental_vacuum").fetchall()
+        return
+
+    free_pages: int = conn.execute("pragma freelist_count").fetchone()[0]
+    pages: int = conn.execute("pragma page_count").fetchone()[0]
+
+    if free_pages and free_pages >= pages * free_fraction:
+        conn.execute("vacuum")
+
+
+def xml_table_stats(path: Path, columns: Iterable[str], chunk_size: int = 10_000_000) -> tuple[set[str], Optional[int]]:
+    """
+    Find the columns of a table XML file that have no non-empty values and count its rows.
+
+    A column is empty if every one of its elements is either nil (`xsi:nil="true"`) or has no attributes and contains
+    only whitespace, comments and empty CDATA sections, as when the rows are parsed with xmltodict. Unlike xmltodict,
+    character references (e.g. `&#32;`) and non-ASCII whitespace are counted as values.
+    The file is scanned in chunks of raw bytes with an expression that only matches non-empty elements of the
+    columns not yet seen with a value, and the scan stops as soon as every column has a value.
+
+    The number of rows is only known if the whole file was read, otherwise it is None.
+    """
+    empty_columns: set[str] = set(columns)
+    expression: Optional[Pattern[bytes]] = None
+    buffer: bytes = b""
+    rows: int = 0
+
+    with path.open("rb") as fh:
+        while empty_columns:
+            chunk: bytes = fh.read(chunk_size)
+            buffer += chunk
+
+            # Only search complete rows, unless the file is finished
+            end: int = (buffer.rfind(b"</row>") + 6) if chunk else len(buffer)
+            start: int = 0
+            rows += buffer.count(b"</row>", 0, end) if end > 5 else 0
+
+            while empty_columns and end > 5:
+                if expression is None:
+                    expression = re_compile(
+                        rb"(?s)<(" + b"|".join(c.encode() for c in sorted(empty_columns)) + rb")(?:"
+                        # An element without attributes with text right after the start tag (the common case)
+                        rb">(?:[^<\s]|<(?!/|!--|!\[CDATA\[\s*]]>))"
+                        # An element without attributes with content other than whitespace, comments and empty CDATA
+                        rb"|\s*>(?:\s|<!--.*?-->|<!\[CDATA\[\s*]]>)*(?:[^<\s]|<(?!/|!--|!\[CDATA\[\s*]]>))"
+                        # An element with attributes that is not nil
+                        rb"|\s+(?!xsi:nil\s*=\s*[\"']true[\"'])[^\s/>](?![^>]*\sxsi:nil\s*=\s*[\"']true[\"']))"
+                    )
+                match: Optional[Match[bytes]] = expression.search(buffer, start, end)
+                if match is None:
+                    break
+                empty_columns.discard(match.group(1).decode())
+                expression = None
+                start = match.start()
+
+            if not chunk:
+                return empty_columns, rows
+            elif end > 5:
+                buffer = buffer[end:]
+
+    return empty_columns, None
+
+
+def xml_empty_columns(path: Path, columns: Iterable[str], chunk_size: int = 10_000_000) -> set[str]:
+    """
+    Find the columns of a table XML file that have no non-empty values.
+    """
+    return xml_table_stats(path, columns, chunk_size)[0]
+
+
+def xml_table_stats_parallel(tables: list[tuple[Path, list[str]]], jobs: int, cache: Optional[Connection] = None
+                             ) -> Iterator[tuple[set[str], Optional[int], dict]]:
+    """
+    Find the empty columns and the number of rows of several table XML files, yielding the results in the order of
+    the given tables with the profile counters of the scans done by worker processes (see `timed_call`).
+
+    If jobs is greater than 1, the files are scanned in a pool of processes with the largest files scheduled first.
+    If a statistics cache is given, only the files without a valid entry are scanned and the new results are saved.
+    """
+    cached: list[Optional[tuple[set[str], Optional[int]]]] = []
+    for path, columns in tables:
+        entry = table_cache_get(cache, path) if cache else None
+        cached.append(entry[1:] if entry and entry[0] == list(columns) else None)
+    missing: list[int] = [i for i, stats in enumerate(cached) if stats is None]
+    executor: Optional[ProcessPoolExecutor] = ProcessPoolExecutor(jobs) if jobs > 1 and len(missing) > 1 else None
+
+    try:
+        futures: dict[int, Future] = {}
+        for i in sorted(missing if executor else [],
+                        key=lambda n: tables[n][0].stat().st_size if tables[n][0].is_file() else 0,
+                        reverse=True):
+            futures[i] = executor.submit(timed_call, xml_table_stats, *tables[i])
+
+        for i, (path, columns) in enumerate(tables):
+            if cached[i] is not None:
+                yield *cached[i], {}
+                continue
+
+            stats, counters = futures[i].result() if i in futures else (xml_table_stats(path, columns), {})
+
+            if cache:
+                table_cache_set(cache, path, columns, *stats)
+
+            yield *stats, counters
+    finally:
+        if executor:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+
+def table_cache_path(archive: Path) -> Path:
+    """
+    Get the path of the statistics cache of an archive, a hidden SQLite file next to the archive folder.
+    """
+    archive = archive.resolve()
+    return archive.with_name(f".{archive.name}.cache.sqlite")
+
+
+def table_cache_connect(path: Path) -> Connection:
+    """
+    Open a statistics cache, creating it if it does not exist.
+
+    Each table file has one entry with its size, modification time and a hash of its first and last bytes, which
+    are checked against the file to discard stale entries, and the statistics themselves: the IDs of its columns,
+    those that are empty, and the number of rows (if known).
+    """
+    conn: Connection = connect(path)
+    conn.execute("create table if not exists tables ("
+                 "path text primary key, size integer, mtime integer, hash text, "
+                 "columns text, empty_columns text, rows integer)")
+    conn.commit()
+    return conn
+
+
+def file_fingerprint(path: Path, sample_size: int = 65_536) -> tuple[int, int, str]:
+    """
+    Get the size, the modification time in nanoseconds, and a hash of the first and last bytes of a file.
+    """
+    stat = path.stat()
+    digest = sha1()
+
+    with path.open("rb") as fh:
+        digest.update(fh.read(sample_size))
+        fh.seek(max(stat.st_size - sample_size, sample_size))
+        digest.update(fh.read(sample_size))
+
+    return stat.st_size, stat.st_mtime_ns, digest.hexdigest()
+
+
+def table_cache_get(cache: Connection, path: Path) -> Optional[tuple[list[str], set[str], Optional[int]]]:
+    """
+    Get the columns, the empty columns and the number of rows of a table file from the statistics cache.
+
+    None is returned if there is no entry or if the file has changed, in which case the stale entry is also removed.
+    """
+    entry: Optional[tuple] = cache.execute(
+        "select size, mtime, hash, columns, empty_columns, rows from tables where path = ?",
+        [str(path.resolve())]
+    ).fetchone()
+
+    if entry is None:
+        return None
+    elif not path.is_file() or (path.stat().st_size, path.stat().st_mtime_ns) != entry[:2] or \
+            file_fingerprint(path) != entry[:3]:
+        table_cache_delete(cache, path)
+        return None
+
+    return loads(entry[3]), set(loads(entry[4])), entry[5]
+
+
+def table_cache_set(cache: Connection, path: Path, columns: list[str], empty_columns: set[str],
+                    rows: Optional[int]):
+    """
+    Save the statistics of a table file in the cache, replacing any existing entry.
+    """
+    cache.execute(
+        "insert or replace into tables (path, size, mtime, hash, columns, empty_columns, rows) "
+        "values (?, ?, ?, ?, ?, ?, ?)",
+        [str(path.resolve()), *file_fingerprint(path), dumps(list(columns)),
+         dumps(sorted(empty_columns)), rows]
+    )
+    cache.commit()
+
+
+def table_cache_delete(cache: Connection, path: Path):
+    cache.execute("delete from tables where path = ?", [str(path.resolve())])
+    cache.commit()
+
+
+def table_cache_update(cache: Connection, archive: Path, stats: dict[int, tuple[list[str], set[str], Optional[int]]],
+                       remove_columns: list[tuple[int, set[str]]], remove_tables: list[int],
+                       add_keys: Iterable[int] = ()):
+    """
+    Update the statistics cache of an archive after its tables were changed.
+
+    The statistics are given with the original index of their table, and they are saved for the new table files with
+    the tables and columns renumbered, the removed columns left out, and the added key columns counted as not empty.
+    The entries of the original table files are removed.
+    """
+    add_keys = set(add_keys)
+
+    for index in {*stats, *remove_tables}:
+        table_cache_delete(cache, archive.joinpath("tables", f"table{index}", f"table{index}.xml"))
+
+    for index, (columns, empty_columns, rows) in sorted(stats.items()):
+        if index in remove_tables:
+            continue
+
+        new_index: int = index - reduce(lambda p, c: (p + 1) if c < index else p, remove_tables, 0)
+        _remove_columns: set[str] = next((cs for t, cs in remove_columns if t == index), set())
+        removed_ids: list[int] = sorted(int(c.removeprefix("c")) for c in _remove_columns)
+        new_columns: dict[str, str] = {
+            c: f"c{int(c.removeprefix('c')) - bisect_left(removed_ids, int(c.removeprefix('c')))}"
+            for c in columns
+            if c not in _remove_columns
+        }
+        path: Path = archive.joinpath("tables", f"table{new_index}", f"table{new_index}.xml")
+
+        if path.is_file():
+            table_cache_set(cache, path,
+                            [*new_columns.values(), *([f"c{len(new_columns) + 1}"] if index in add_keys else [])],
+                            {new_columns[c] for c in empty_columns if c in new_columns},
+                            rows)
+
+
 def rmdir(path: Path):
     if not path.is_dir():
         return path.unlink(missing_ok=True)
@@ -67,24 +512,13 @@ def rmdir(path: Path):
     path.rmdir()
 
 
-def print_with_file(log_file: Optional[Path]):
-    if log_file:
-        def inner(*args, **kwargs):
-            print(*args, **kwargs)
-            print(datetime.now().isoformat().strip(), (kwargs.get("sep", " ").join(map(str, args)).strip()),
-                  file=log_file.open("a"))
-    else:
-        def inner(*args, **kwargs):
-            print(*args, **kwargs)
-
-    return inner
-
-
-def table_index_update(path: Path, remove_columns: list[tuple[int, set[str]]], remove_tables: list[int],
-                       out_path: Optional[Path] = None) -> Path:
-    out_path = out_path or path.with_suffix(".new" + path.suffix)
+def tables_index_update(tables_index: dict, remove_columns: list[tuple[int, set[str]]],
+                        remove_tables: list[int]) -> dict:
+    """
+    Remove tables and columns from a parsed tableIndex.xml, renumbering the remaining tables and columns.
 
-    tables_index = parse_xml(path.read_text(), force_list=True)
+    The columns to remove are given with the original index of their table.
+    """
     new_table_index = deepcopy(tables_index)
     new_table_index["siardDiark"][0]["tables"][0]["table"] = []
 
@@ -92,9 +526,9 @@ def table_index_update(path: Path, remove_columns: list[tuple[int, set[str]]], r
         index: int = int(table["folder"][0].removeprefix("table"))
         if index in remove_tables:
             continue
+        _remove_columns: set[str] = next((cs for t, cs in remove_columns if t == index), set())
         index -= reduce(lambda p, c: (p + 1) if c < index else p, remove_tables, 0)
         table["folder"][0] = f"table{index}"
-        _remove_columns: set[str] = next((cs for t, cs in remove_columns if t == index), set())
         columns: list[dict] = table["columns"][0]["column"]
         table["columns"][0]["column"] = [c for c in columns if c["columnID"][0] not in _remove_columns]
         for column in table["columns"][0]["column"]:
@@ -103,6 +537,15 @@ def table_index_update(path: Path, remove_columns: list[tuple[int, set[str]]], r
             column["columnID"][0] = f"c{col_id}"
         new_table_index["siardDiark"][0]["tables"][0]["table"].append(table)
 
+    return new_table_index
+
+
+def table_index_update(path: Path, remove_columns: list[tuple[int, set[str]]], remove_tables: list[int],
+                       out_path: Optional[Path] = None) -> Path:
+    out_path = out_path or path.with_suffix(".new" + path.suffix)
+
+    new_table_index = tables_index_update(parse_xml(path.read_text(), force_list=True), remove_columns, remove_tables)
+
     with out_path.open("w") as fh:
         unparse_xml(new_table_index, fh, "utf-8")
 
@@ -110,67 +553,165 @@ def table_index_update(path: Path, remove_columns: list[tuple[int, set[str]]], r
 
 
 # noinspection HttpUrlsUsage
-def table_xml_update(path: Path, index: int, remove_columns: list[str], out_path: Optional[Path] = None) -> Path:
-    remove_columns_indices = [int(c.removeprefix("c")) for c in remove_columns]
+def table_xml_header(index: int) -> bytes:
+    """
+    Get the XML declaration and root element opening of a table XML file.
+    """
+    return (
+        f'<?xml version="1.0" encoding="UTF-8" ?>\n'
+        f'<table '
+        f'xsi:schemaLocation="http://www.sa.dk/xmlns/siard/1.0/schema0/table{index}.xsd ./table{index}.xsd" '
+        f'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" '
+        f'xmlns="http://www.sa.dk/xmlns/siard/1.0/schema0/table{index}.xsd">\n'
+    ).encode()
+
+
+def table_xml_body_start(fi: BinaryIO, chunk_size: int = 1_000_000) -> int:
+    """
+    Find the offset of the first row of a table XML file, or -1 if the table has no rows.
+    """
+    fi.seek(0)
+    buffer: bytes = b""
+    offset: int = 0
+    chunk: bytes = fi.read(chunk_size)
+
+    while chunk:
+        buffer = buffer[-4:] + chunk
+        match: Optional[Match[bytes]] = row_start.search(buffer)
+        if match is not None:
+            return offset + match.start() - (len(buffer) - len(chunk))
+        offset += len(chunk)
+        chunk = fi.read(chunk_size)
+
+    return -1
+
+
+def table_xml_renumber(path: Path, index: int, out_path: Optional[Path] = None) -> Path:
+    """
+    Change the number of a table XML file by replacing its header, leaving the rows untouched.
+
+    If out_path is the same as path and the new header is no longer than the old one, the header is patched in
+    place and padded with whitespace. Otherwise, the new header is written to a new file and the rows are copied
+    after it with file_copy_range.
+    """
     out_path = out_path or path.with_suffix(".new" + path.suffix)
+    header: bytes = table_xml_header(index)
 
     with path.open("rb") as fi:
-        if remove_columns:
-            with out_path.open("w", encoding="utf-8") as fo:
-                fo.write('<?xml version="1.0" encoding="UTF-8" ?>\n')
-                fo.write(
-                    f'<table '
-                    f'xsi:schemaLocation="http://www.sa.dk/xmlns/siard/1.0/schema0/table{index}.xsd ./table{index}.xsd" '
-                    f'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" '
-                    f'xmlns="http://www.sa.dk/xmlns/siard/1.0/schema0/table{index}.xsd">\n')
-
-                def callback(_, row: dict):
-                    new_row: dict = {}
-                    for col_id, col in row.items():
-                        if col_id in remove_columns:
-                            continue
-                        col_index: int = int(col_id.removeprefix("c"))
-                        col_index -= reduce(lambda p, c: (p + 1) if c < col_index else p, remove_columns_indices, 0)
-                        new_row[f"c{col_index}"] = col
-                    unparse_xml({"row": new_row}, fo, "utf-8", full_document=False)
-                    fo.write("\n")
-                    return True
-
-                parse_xml(fi, item_depth=2, item_callback=callback, force_list=True)
-                fo.write('</table>')
+        start: int = table_xml_body_start(fi)
+
+    if out_path == path and len(header) <= start:
+        with path.open("r+b") as fh:
+            fh.write(header[:-1] + (b" " * (start - len(header))) + header[-1:])
+        return out_path
+
+    out_path_tmp: Path = out_path.with_name("." + out_path.name) if out_path == path else out_path
+
+    with path.open("rb") as fi, out_path_tmp.open("wb") as fo:
+        fo.write(header)
+        if start < 0:
+            fo.write(b"</table>")
         else:
-            with out_path.open("wb") as fo:
-                fo.write('<?xml version="1.0" encoding="UTF-8" ?>\n'.encode())
-                fo.write(
-                    (
-                        f'<table '
-                        f'xsi:schemaLocation="http://www.sa.dk/xmlns/siard/1.0/schema0/table{index}.xsd ./table{index}.xsd" '
-                        f'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" '
-                        f'xmlns="http://www.sa.dk/xmlns/siard/1.0/schema0/table{index}.xsd">\n'
-                    ).encode()
-                )
-
-                chunk: bytes = bytes(5)
-                while chunk != b"<row>":
-                    new_byte: bytes = fi.read(1)
-                    if not new_byte:
-                        chunk = "</table>".encode()
-                        break
-                    chunk = chunk[1:] + new_byte
-
-                while chunk:
-                    fo.write(chunk)
-                    chunk = fi.read(10_000_000)
+            file_copy_range(fi, fo, start)
 
-    return out_path
+    return out_path_tmp.replace(out_path)
+
+
+def table_xml_rewrite_rows(fi: BinaryIO, fo: BinaryIO, rewrite: Callable[[bytes], bytes], chunk_size: int = 1_000_000):
+    """
+    Copy the rows of a table XML file, from the start of the first row to the end of the file, through a function.
+
+    The function is given chunks of complete rows (the last chunk also contains the end of the file).
+    """
+    start: int = table_xml_body_start(fi, chunk_size)
+
+    if start < 0:
+        fo.write(b"</table>")
+        return
+
+    fi.seek(start)
+    buffer: bytes = b""
+
+    while True:
+        chunk: bytes = fi.read(chunk_size)
+        buffer += chunk
+
+        # Only rewrite complete rows, unless the file is finished
+        end: int = (buffer.rfind(b"</row>") + 6) if chunk else len(buffer)
+        if end > 5 or not chunk:
+            fo.write(rewrite(buffer[:end]))
+            buffer = buffer[end:]
+
+        if not chunk:
+            break
+
+
+def rows_drop_columns(remove_columns: list[str]) -> Callable[[bytes], bytes]:
+    """
+    Get a function that removes columns from chunks of complete rows, renaming the remaining columns to close the gaps.
+
+    The rows are kept byte for byte, except for the removed elements (and the whitespace preceding them) and the
+    names of the renamed columns.
+    """
+    remove_columns_indices: list[int] = sorted(int(c.removeprefix("c")) for c in remove_columns)
+    rename: dict[bytes, bytes] = {}
+    remove_expression: Pattern[bytes] = re_compile(
+        rb">(?:\s*<(" + b"|".join(f"c{c}".encode() for c in remove_columns_indices) + rb")(?=[\s/>])"
+        rb"[^>]*?(?:/>|>[^<]*(?:<(?!/\1\s*>)[^<]*)*</\1\s*>))+"
+    )
+    rename_expression: Pattern[bytes] = re_compile(rb"(</?)(c\d+)(?=[\s/>])")
+
+    def rewrite(rows: bytes) -> bytes:
+        # Split the rows into text, tag openings and column names, so that names are at every third index
+        parts: list[bytes] = rename_expression.split(remove_expression.sub(b">", rows))
+        names: list[bytes] = parts[2::3]
+
+        for name in set(names).difference(rename):
+            col_index: int = int(name[1:])
+            rename[name] = f"c{col_index - bisect_left(remove_columns_indices, col_index)}".encode()
+
+        parts[2::3] = map(rename.__getitem__, names)
+
+        return b"".join(parts)
+
+    return rewrite
+
+
+def table_xml_drop_columns(fi: BinaryIO, fo: BinaryIO, remove_columns: list[str], chunk_size: int = 1_000_000):
+    """
+    Copy the rows of a table XML file without the given columns, renaming the remaining columns to close the gaps.
+    """
+    table_xml_rewrite_rows(fi, fo, rows_drop_columns(remove_columns), chunk_size)
+
+
+def table_xml_update(path: Path, index: int, remove_columns: list[str], out_path: Optional[Path] = None,
+                     chunk_size: int = 1_000_000) -> Path:
+    """
+    Renumber a table XML file and remove columns from it.
+
+    If out_path is the same as path, the file is updated in place (or through a temporary file).
+    """
+    out_path = out_path or path.with_suffix(".new" + path.suffix)
+
+    if not remove_columns:
+        return table_xml_renumber(path, index, out_path)
+
+    out_path_tmp: Path = out_path.with_name("." + out_path.name) if out_path == path else out_path
+
+    with path.open("rb") as fi, out_path_tmp.open("wb", buffering=chunk_size * 10) as fo:
+        fo.write(table_xml_header(index))
+        table_xml_drop_columns(fi, fo, remove_columns, chunk_size)
+
+    return out_path_tmp.replace(out_path)
 
 
 # noinspection HttpUrlsUsage
-def table_xsd_update(path: Path, table_index: int, remove_columns: list[str], out_path: Optional[Path] = None):
+def xsd_update(xsd: dict, table_index: int, remove_columns: list[str]) -> dict:
+    """
+    Renumber a parsed table XSD and remove columns from it, renaming the remaining columns to close the gaps.
+    """
     remove_columns_indices = [int(c.removeprefix("c")) for c in remove_columns]
-    out_path = out_path or path.with_suffix(".new" + path.suffix)
 
-    xsd = parse_xml(path.read_bytes(), "utf-8", force_list=True)
     xsd["xs:schema"][0]["@xmlns"] = f"http://www.sa.dk/xmlns/siard/1.0/schema0/table{table_index}.xsd"
     xsd["xs:schema"][0]["@targetNamespace"] = f"http://www.sa.dk/xmlns/siard/1.0/schema0/table{table_index}.xsd"
     xsd["xs:schema"][0]["xs:complexType"][0]["xs:sequence"][0]["xs:element"] = [
@@ -185,6 +726,15 @@ def table_xsd_update(path: Path, table_index: int, remove_columns: list[str], ou
         column_index_diff: int = reduce(lambda p, c: (p + 1) if c < column_index else p, remove_columns_indices, 0)
         column["@name"] = f"c{column_index - column_index_diff}"
 
+    return xsd
+
+
+# noinspection HttpUrlsUsage
+def table_xsd_update(path: Path, table_index: int, remove_columns: list[str], out_path: Optional[Path] = None):
+    out_path = out_path or path.with_suffix(".new" + path.suffix)
+
+    xsd = xsd_update(parse_xml(path.read_bytes(), "utf-8", force_list=True), table_index, remove_columns)
+
     with out_path.open("w") as fh:
         unparse_xml(xsd, fh, "utf-8")
 
@@ -192,66 +742,110 @@ def table_xsd_update(path: Path, table_index: int, remove_columns: list[str], ou
 
 
 # noinspection SqlNoDataSourceInspection
-def clean_sqlite(file: Path, commit: bool, log_file: Optional[Path]):
+def clean_sqlite(file: Path, commit: bool, log_file: Optional[Path], rebuild: bool = False):
     echo = print_with_file(log_file)
 
     print(file.name)
 
     # Connect to the database
-    environ["SQLITE_TMPDIR"] = str(file.parent.resolve())
+    os.environ["SQLITE_TMPDIR"] = str(file.parent.resolve())
     conn: Connection = connect(file)
 
     columns_to_remove: dict[str, list[str]] = {}
+    tables: list[str] = sqlite_get_tables(conn)
+    progress: Progress = Progress(len(tables), "tables")
 
-    for table in sqlite_get_tables(conn):
-        for column in sqlite_get_columns(conn, table):
-            # Prepare output string
-            line = f"{file.name}/{table}/{column}"
-            print(line, end="... ", flush=True)
+    for table in tables:
+        line = f"{file.name}/{table}"
+        progress.update(line)
+
+        # Check all columns of the table in one scan
+        with profile.phase(f"{file.name}/{table}", "scan"):
+            empty_columns: list[str] = sqlite_empty_columns(conn, table, sqlite_get_columns(conn, table))
+
+        progress.update(advance=1)
+
+        if empty_columns:
+            progress.clear()
 
-            if sqlite_has_value(conn, table, column):
-                # If the column is not empty, clear the output line
-                print("\r" + (" " * (len(line) + 4)) + "\r", end="", flush=True)
-            else:
-                echo(f"\r{line}/empty")
-                if commit:
-                    columns_to_remove[table] = columns_to_remove.get(table, []) + [column]
+        for column in empty_columns:
+            echo(f"{line}/{column}/empty",
+                 event={"file": file.name, "table": table, "column": column, "action": "empty"})
+            if commit:
+                columns_to_remove[table] = columns_to_remove.get(table, []) + [column]
+
+    progress.close()
 
     if columns_to_remove and commit:
+        progress = Progress(len(columns_to_remove), "tables")
+        foreign_keys: int = conn.execute("pragma foreign_keys").fetchone()[0]
+
         try:
+            if rebuild:
+                # Run all the table rebuilds in one transaction
+                conn.execute("pragma foreign_keys = off")
+                conn.execute("pragma legacy_alter_table = on")
+                conn.execute("begin")
+
             for table, columns in columns_to_remove.items():
-                if set(columns) == set(sqlite_get_columns(conn, table)):
-                    # If all columns are empty, remove table
-                    print(f"{file.name}/{table}/removing...", end="", flush=True)
-                    sqlite_drop_table(conn, table)
-                    echo(f"\r{file.name}/{table}/removed    ")
-                else:
-                    # Remove one column at a time
-                    for column in columns:
-                        print(f"{file.name}/{table}/{column}/removing...", end="", flush=True)
-                        sqlite_drop_column(conn, table, column)
-                        echo(f"\r{file.name}/{table}/{column}/removed    ")
+                progress.update(f"{file.name}/{table}/removing")
+                with profile.phase(f"{file.name}/{table}", "drop"):
+                    if set(columns) == set(sqlite_get_columns(conn, table)):
+                        # If all columns are empty, remove table
+                        sqlite_drop_table(conn, table)
+                        progress.clear()
+                        echo(f"{file.name}/{table}/removed",
+                             event={"file": file.name, "table": table, "action": "removed"})
+                    elif rebuild:
+                        # Remove all columns at once
+                        sqlite_drop_columns(conn, table, columns)
+                        progress.clear()
+                        for column in columns:
+                            echo(f"{file.name}/{table}/{column}/removed",
+                                 event={"file": file.name, "table": table, "column": column, "action": "removed"})
+                    else:
+                        # Remove one column at a time
+                        for column in columns:
+                            progress.update(f"{file.name}/{table}/{column}/removing")
+                            sqlite_drop_column(conn, table, column)
+                            progress.clear()
+                            echo(f"{file.name}/{table}/{column}/removed",
+                                 event={"file": file.name, "table": table, "column": column, "action": "removed"})
+                progress.update(advance=1)
+
+            progress.close()
 
             # Show temporary message during cleanup
             line = f"{file.name}/cleaning..."
             print(line, end="", flush=True)
 
             # Commit all changes and clean the database with vacuum
-            conn.commit()
-            conn.execute("vacuum")
+            with profile.phase(file.name, "commit"):
+                conn.commit()
+
+            with profile.phase(file.name, "vacuum") as counters:
+                counters["bytes_read"] = file.stat().st_size if profile else 0
+                if rebuild:
+                    conn.execute("pragma legacy_alter_table = off")
+                    conn.execute(f"pragma foreign_keys = {foreign_keys}")
+                    sqlite_vacuum(conn)
+                else:
+                    conn.execute("vacuum")
+                counters["bytes_written"] = file.stat().st_size if profile else 0
 
             print("\r" + (" " * len(line)) + "\r", end="", flush=True)
         except Exception as err:
-            echo(f"ERROR: {err!r}")
-            echo("ERROR: Changes interrupted before committing")
+            echo(f"ERROR: {err!r}", event={"file": file.name, "action": "error"})
+            echo("ERROR: Changes interrupted before committing", event={"file": file.name, "action": "error"})
             raise
 
     conn.close()
 
 
 # noinspection DuplicatedCode
-def clean_xml(archive: Path, commit: bool, log_file: Optional[Path]):
+def clean_xml(archive: Path, commit: bool, log_file: Optional[Path], jobs: int = 1, cache: bool = False):
     echo = print_with_file(log_file)
+    cache_conn: Optional[Connection] = table_cache_connect(table_cache_path(archive)) if cache else None
 
     print(archive.name)
 
@@ -261,48 +855,51 @@ def clean_xml(archive: Path, commit: bool, log_file: Optional[Path]):
     tables: list[dict] = tables_index["siardDiark"][0]["tables"][0]["table"]
     tables_to_remove: list[int] = []
     columns_to_remove: list[tuple[int, set[str]]] = []
+    tables_stats: dict[int, tuple[list[str], set[str], Optional[int]]] = {}
 
-    for table in tables:
-        line: str = f"{archive.name}/{table['folder'][0]}/{table['name'][0]}..."
-        print(line, end="", flush=True)
-        xml_path: Path = archive.joinpath("tables", table["folder"][0], table["folder"][0]).with_suffix(".xml")
-        columns: list[dict] = table["columns"][0]["column"]
-        empty_columns: set[str] = {c["columnID"][0] for c in columns}
-
-        def callback(_, row):
-            _empty_columns: list[str] = []
-
-            for col_id in empty_columns:
-                value = row[col_id]
-                if isinstance(value, dict):
-                    if value.get("@xsi:nil", None) != "true":
-                        _empty_columns.append(col_id)
-                elif value:
-                    _empty_columns.append(col_id)
-
-            empty_columns.difference_update(_empty_columns)
-
-            return len(empty_columns) > 0
-
-        try:
-            parse_xml(xml_path.open("rb"), item_depth=2, item_callback=callback)
-        except ParsingInterrupted:
-            pass
-
-        if len(empty_columns) == len(columns):
-            tables_to_remove.append(int(table["folder"][0].removeprefix("table")))
-            echo(f"\r{archive.name}/{table['folder'][0]}/{table['name'][0]}/empty")
-        elif empty_columns:
-            columns_to_remove.append((int(table["folder"][0].removeprefix("table")), empty_columns))
-            for column in [c for c in columns if c["columnID"][0] in empty_columns]:
-                echo(f"\r{archive.name}/{table['folder'][0]}/{table['name'][0]}/"
-                     f"{column['columnID'][0]}/{column['name'][0]}/empty")
-        else:
-            print("\r" + (" " * len(line)) + "\r", end="", flush=True)
+    tables_paths: list[Path] = [
+        archive.joinpath("tables", t["folder"][0], t["folder"][0]).with_suffix(".xml") for t in tables
+    ]
+    tables_sizes: list[int] = [p.stat().st_size if p.is_file() else 0 for p in tables_paths]
+    scans: Iterator[tuple[set[str], Optional[int], dict]] = xml_table_stats_parallel(
+        [(p, [c["columnID"][0] for c in t["columns"][0]["column"]]) for p, t in zip(tables_paths, tables)],
+        jobs,
+        cache_conn
+    )
+    progress: Progress = Progress(sum(tables_sizes))
+
+    try:
+        for table, table_size in zip(tables, tables_sizes):
+            progress.update(f"{archive.name}/{table['folder'][0]}/{table['name'][0]}")
+            columns: list[dict] = table["columns"][0]["column"]
+            with profile.phase(f"{archive.name}/{table['folder'][0]}", "scan") as counters:
+                empty_columns, rows, worker_counters = next(scans)
+                counters.update(worker_counters, bytes_read=table_size, rows=rows or 0)
+            progress.update(advance=table_size)
+            tables_stats[int(table["folder"][0].removeprefix("table"))] = \
+                ([c["columnID"][0] for c in columns], empty_columns, rows)
+
+            if len(empty_columns) == len(columns):
+                tables_to_remove.append(int(table["folder"][0].removeprefix("table")))
+                progress.clear()
+                echo(f"{archive.name}/{table['folder'][0]}/{table['name'][0]}/empty",
+                     event={"file": archive.name, "table": table["folder"][0], "action": "empty"})
+            elif empty_columns:
+                columns_to_remove.append((int(table["folder"][0].removeprefix("table")), empty_columns))
+                progress.clear()
+                for column in [c for c in columns if c["columnID"][0] in empty_columns]:
+                    echo(f"{archive.name}/{table['folder'][0]}/{table['name'][0]}/"
+                         f"{column['columnID'][0]}/{column['name'][0]}/empty",
+                         event={"file": archive.name, "table": table["folder"][0], "column": column["columnID"][0],
+                                "action": "empty"})
+    finally:
+        progress.close()
+        scans.close()
 
     if (tables_to_remove or columns_to_remove) and commit:
         try:
-            table_index_update(tables_index_path, columns_to_remove, tables_to_remove, tables_index_path)
+            with profile.phase(archive.name, "index"):
+                table_index_update(tables_index_path, columns_to_remove, tables_to_remove, tables_index_path)
 
             if tables_to_remove:
                 for table in sorted(tables, key=lambda t: int(t["folder"][0].removeprefix("table"))):
@@ -310,13 +907,16 @@ def clean_xml(archive: Path, commit: bool, log_file: Optional[Path]):
                     table_folder: Path = archive.joinpath("tables", table["folder"][0])
 
                     if index in tables_to_remove:
-                        echo(f"{archive.name}/{table['folder'][0]}/{table['name'][0]}/removed")
-                        rmdir(archive.joinpath("tables", table["folder"][0]))
+                        echo(f"{archive.name}/{table['folder'][0]}/{table['name'][0]}/removed",
+                             event={"file": archive.name, "table": table["folder"][0], "action": "removed"})
+                        with profile.phase(f"{archive.name}/{table['folder'][0]}", "remove"):
+                            rmdir(archive.joinpath("tables", table["folder"][0]))
                         continue
                     elif index <= min(tables_to_remove, default=-1):
                         continue
                     elif not table_folder.is_dir():
-                        echo(f"{archive.name}/{table['folder'][0]}/{table['name'][0]}/folder not found")
+                        echo(f"{archive.name}/{table['folder'][0]}/{table['name'][0]}/folder not found",
+                             event={"file": archive.name, "table": table["folder"][0], "action": "not found"})
                         continue
 
                     _columns_to_remove: set[str] = next((cs for t, cs in columns_to_remove if t == index), set())
@@ -326,20 +926,25 @@ def clean_xml(archive: Path, commit: bool, log_file: Optional[Path]):
                     if not index_diff and not _columns_to_remove:
                         continue
 
-                    echo(f"{archive.name}/{table['folder'][0]}/{table['name'][0]}/moved to table{new_index}")
+                    echo(f"{archive.name}/{table['folder'][0]}/{table['name'][0]}/moved to table{new_index}",
+                         event={"file": archive.name, "table": table["folder"][0], "action": "moved",
+                                "value": f"table{new_index}"})
 
                     xml_path: Path = table_folder.joinpath(table["folder"][0]).with_suffix(".xml")
-                    xml_path_tmp = table_xml_update(xml_path, new_index, list(_columns_to_remove),
-                                                    xml_path.with_name("." + xml_path.name))
-                    xml_path.unlink(missing_ok=True)
-                    xml_path_tmp.rename(xml_path.with_name(f"table{new_index}.xml"))
-
                     xsd_path: Path = table_folder.joinpath(table["folder"][0]).with_suffix(".xsd")
-                    table_xsd_update(xsd_path, new_index, list(_columns_to_remove), xsd_path)
-                    xsd_path.rename(xsd_path.with_name(f"table{new_index}.xsd"))
 
-                    if new_index != index:
-                        xml_path.parent.rename(xml_path.parent.with_name(f"table{new_index}"))
+                    with profile.phase(f"{archive.name}/{table['folder'][0]}", "rewrite") as counters:
+                        counters["bytes_read"] = xml_path.stat().st_size if profile else 0
+                        table_xml_update(xml_path, new_index, list(_columns_to_remove), xml_path)
+                        table_xsd_update(xsd_path, new_index, list(_columns_to_remove), xsd_path)
+                        counters["bytes_written"] = xml_path.stat().st_size if profile else 0
+
+                    with profile.phase(f"{archive.name}/{table['folder'][0]}", "rename"):
+                        xml_path.rename(xml_path.with_name(f"table{new_index}.xml"))
+                        xsd_path.rename(xsd_path.with_name(f"table{new_index}.xsd"))
+
+                        if new_index != index:
+                            xml_path.parent.rename(xml_path.parent.with_name(f"table{new_index}"))
 
             for index, column_ids in columns_to_remove:
                 if tables_to_remove and index > min(tables_to_remove, default=-1):
@@ -348,26 +953,35 @@ def clean_xml(archive: Path, commit: bool, log_file: Optional[Path]):
                 table_folder: Path = archive.joinpath("tables", table["folder"][0])
 
                 if not table_folder.is_dir():
-                    echo(f"{archive.name}/{table['folder'][0]}/{table['name'][0]}/folder not found")
+                    echo(f"{archive.name}/{table['folder'][0]}/{table['name'][0]}/folder not found",
+                         event={"file": archive.name, "table": table["folder"][0], "action": "not found"})
                     continue
 
                 xml_path: Path = table_folder.joinpath(table["folder"][0]).with_suffix(".xml")
-                table_xml_update(xml_path, index, list(column_ids), xml_path.with_name("." + xml_path.name))
-                xml_path.unlink(missing_ok=True)
-                xml_path.with_name("." + xml_path.name).rename(xml_path)
-
                 xsd_path: Path = table_folder.joinpath(table["folder"][0]).with_suffix(".xsd")
-                table_xsd_update(xsd_path, index, list(column_ids), xsd_path)
+
+                with profile.phase(f"{archive.name}/{table['folder'][0]}", "rewrite") as counters:
+                    counters["bytes_read"] = xml_path.stat().st_size if profile else 0
+                    table_xml_update(xml_path, index, list(column_ids), xml_path)
+                    table_xsd_update(xsd_path, index, list(column_ids), xsd_path)
+                    counters["bytes_written"] = xml_path.stat().st_size if profile else 0
+
+            if cache_conn:
+                with profile.phase(archive.name, "cache"):
+                    table_cache_update(cache_conn, archive, tables_stats, columns_to_remove, tables_to_remove)
 
             print(f"\r{archive.name}/{len(tables_to_remove)} tables "
                   f"and {len([c for _, cs in columns_to_remove for c in cs])} columns removed")
         except (Exception, BaseException) as err:
             print()
             echo("ERROR: The operation was interrupted before all changes could be written.",
-                 f"Archive {archive.name} is likely corrupted.")
+                 f"Archive {archive.name} is likely corrupted.", event={"file": archive.name, "action": "error"})
             print()
             raise err
 
+    if cache_conn:
+        cache_conn.close()
+
 
 def cli():
     """
@@ -383,16 +997,25 @@ def cli():
                         help="whether the files are archives or SQLite databases")
     parser.add_argument("files", nargs="+", type=Path, help="the databases/archives to clean")
     parser.add_argument("--commit", action="store_true", required=False, help="commit changes to database")
+    parser.add_argument("--rebuild", action="store_true", required=False,
+                        help="remove all empty columns of a table by rebuilding it once (sqlite only)")
+    parser.add_argument("--jobs", type=int, default=1,
+                        help="number of tables to scan in parallel (archive only)")
+    parser.add_argument("--cache", action="store_true", required=False,
+                        help="keep the results of each table in a cache next to the archive and skip unchanged tables "
+                             "(archive only)")
     parser.add_argument("--log-file", type=Path, required=True, help="write change events to log file")
+    profile_arguments(parser)
 
     args = parser.parse_args()
+    profile.start(args.profile, args.profile_stats)
 
     if args.type == "sqlite":
         for file in args.files:
-            clean_sqlite(file, args.commit, args.log_file)
+            clean_sqlite(file, args.commit, args.log_file, args.rebuild)
     elif args.type == "archive":
         for archive in args.files:
-            clean_xml(archive, args.commit, args.log_file)
+            clean_xml(archive, args.commit, args.log_file, args.jobs, args.cache)
 
 
 if __name__ == '__main__':
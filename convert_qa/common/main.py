@@ -0,0 +1,408 @@
+import os
+import sys
+from argparse import ArgumentParser
+from atexit import register as atexit_register
+from contextlib import contextmanager
+from contextlib import nullcontext
+from cProfile import Profile as CProfile
+from datetime import datetime
+from datetime import timedelta
+from io import SEEK_END
+from json import dumps
+from pathlib import Path
+from shutil import copyfileobj
+from shutil import get_terminal_size
+from sys import platform as sys_platform
+from threading import Lock
+from threading import Timer
+from time import monotonic
+from time import perf_counter
+from typing import BinaryIO
+from typing import Callable
+from typing import ContextManager
+from typing import Iterator
+from typing import Optional
+from typing import TextIO
+
+try:
+    from resource import RUSAGE_CHILDREN
+    from resource import RUSAGE_SELF
+    from resource import getrusage
+except ImportError:  # not available on Windows
+    getrusage = None
+
+
+class LogWriter:
+    """
+    A log file that is opened once and written in batches.
+
+    Events are buffered in memory and written when the buffer is full, at most flush_interval seconds after they were
+    buffered, also while no other events are written (e.g. during a long vacuum), and when the writer is closed.
+    If the file has a `.jsonl` suffix, events are written as JSON Lines
+    objects with the time, the message and the event's fields, otherwise as lines of text with the time and the
+    message.
+    """
+
+    def __init__(self, path: Path, buffer_size: int = 1_000_000, flush_interval: float = 1.0):
+        self.path: Path = path
+        self.json: bool = path.suffix.lower() == ".jsonl"
+        self.buffer: list[str] = []
+        self.buffer_length: int = 0
+        self.buffer_size: int = buffer_size
+        self.flush_interval: float = flush_interval
+        self.flush_time: float = monotonic()
+        self.handle: Optional[TextIO] = None
+        # The buffer is also flushed by a timer thread, started when an event is buffered
+        self.lock: Lock = Lock()
+        self.timer: Optional[Timer] = None
+
+    def write(self, message: str, event: Optional[dict] = None):
+        if self.json:
+            line: str = dumps({"time": datetime.now().isoformat(), "message": message, **(event or {})},
+                              ensure_ascii=False, default=str)
+        else:
+            line: str = f"{datetime.now().isoformat()} {message}"
+
+        with self.lock:
+            self.buffer.append(line + "\n")
+            self.buffer_length += len(line) + 1
+
+            if self.buffer_length >= self.buffer_size or monotonic() - self.flush_time >= self.flush_interval:
+                self.write_buffer()
+            elif self.timer is None:
+                self.timer = Timer(self.flush_interval, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def write_buffer(self):
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+        if self.buffer:
+            if self.handle is None:
+                self.handle = self.path.open("a", encoding="utf-8")
+            self.handle.write("".join(self.buffer))
+            self.handle.flush()
+            self.buffer.clear()
+            self.buffer_length = 0
+        self.flush_time = monotonic()
+
+    def flush(self):
+        with self.lock:
+            self.write_buffer()
+
+    def close(self):
+        with self.lock:
+            self.write_buffer()
+            if self.handle:
+                self.handle.close()
+                self.handle = None
+
+
+log_writers: dict[Path, LogWriter] = {}
+
+
+def log_writers_close():
+    for writer in log_writers.values():
+        writer.close()
+
+
+def log_writer(path: Path) -> LogWriter:
+    """
+    Get the writer of a log file, shared by all the tools that log to the same file in a process.
+
+    All writers are flushed and closed when the process exits, including when it exits because of an error.
+    """
+    path = path.resolve()
+
+    if not log_writers:
+        atexit_register(log_writers_close)
+
+    if path not in log_writers:
+        log_writers[path] = LogWriter(path)
+
+    return log_writers[path]
+
+
+def print_with_file(log_file: Optional[Path]):
+    """
+    Get a function that prints messages and writes them to the log file, if given.
+
+    The function takes the same arguments as `print` and an optional event with the structured fields of the message
+    (e.g., file, table, column, offset and action), which are saved if the log file is in the JSON Lines format.
+    Messages starting with "ERROR" are written to the log file immediately.
+    """
+    writer: Optional[LogWriter] = log_writer(log_file) if log_file else None
+
+    def inner(*args, event: Optional[dict] = None, **kwargs):
+        print(*args, **kwargs)
+        if writer:
+            message: str = kwargs.get("sep", " ").join(map(str, args)).strip()
+            writer.write(message, event)
+            if message.startswith("ERROR"):
+                writer.flush()
+
+    return inner
+
+
+def format_amount(amount: float, unit: str) -> str:
+    """
+    Format an amount of bytes (unit "B") with a decimal prefix, and other amounts (e.g. rows or tables) as they are.
+    """
+    if unit != "B":
+        return f"{amount:.1f} {unit}" if amount < 10 else f"{amount:.0f} {unit}"
+    for prefix in ("", "k", "M", "G"):
+        if amount < 1000:
+            return f"{amount:.1f} {prefix}B" if prefix else f"{amount:.0f} B"
+        amount /= 1000
+    return f"{amount:.1f} TB"
+
+
+class Progress:
+    """
+    A progress line with the throughput and the estimated time left, drawn at most once every `interval` seconds.
+
+    On a terminal the line is redrawn in place. When the output is not a terminal (e.g. a log file or a CI job),
+    a plain line is printed every `plain_interval` seconds instead, so long runs still show their progress without
+    filling the output. Call `clear` before printing other messages while the line is drawn.
+    """
+
+    def __init__(self, total: int = 0, unit: str = "B", interval: float = 0.2, plain_interval: float = 10):
+        self.total: int = total
+        self.unit: str = unit
+        self.done: int = 0
+        self.label: str = ""
+        self.tty: bool = sys.stdout.isatty()
+        self.interval: float = interval if self.tty else plain_interval
+        self.start_time: float = monotonic()
+        self.draw_time: float = 0 if self.tty else self.start_time
+        self.width: int = 0
+
+    def update(self, label: Optional[str] = None, done: Optional[int] = None, advance: int = 0):
+        if label is not None:
+            self.label = label
+        if done is not None:
+            self.done = done
+        self.done += advance
+
+        now: float = monotonic()
+        if now - self.draw_time >= self.interval:
+            self.draw(now)
+
+    def line(self, now: float) -> str:
+        elapsed: float = now - self.start_time
+        rate: float = self.done / elapsed if elapsed > 0 else 0
+        line: str = self.label
+
+        if self.total:
+            line += f" {min(self.done / self.total, 1) * 100:.1f}%"
+        line += f" {format_amount(rate, self.unit)}/s"
+        if self.total and rate:
+            line += f" ETA {timedelta(seconds=round(max(self.total - self.done, 0) / rate))}"
+
+        return line
+
+    def draw(self, now: float):
+        line: str = self.line(now)
+        self.draw_time = now
+
+        if self.tty:
+            line = line[:max(get_terminal_size((0, 0)).columns - 1, 0) or None]
+            print("\r" + line.ljust(self.width), end="", flush=True)
+            self.width = len(line)
+        else:
+            print(line, flush=True)
+
+    def clear(self):
+        if self.width:
+            print("\r" + (" " * self.width) + "\r", end="", flush=True)
+            self.width = 0
+            self.draw_time = 0
+
+    def close(self):
+        self.clear()
+
+
+def peak_memory() -> Optional[int]:
+    """
+    Get the peak resident memory in bytes of the process or of its largest child process (e.g., a worker of a process
+    pool), or None where it cannot be measured.
+    """
+    if getrusage is None:
+        return None
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    unit: int = 1 if sys_platform == "darwin" else 1024
+    return max(getrusage(RUSAGE_SELF).ru_maxrss, getrusage(RUSAGE_CHILDREN).ru_maxrss) * unit
+
+
+def timed_call(function: Callable, *args) -> tuple:
+    """
+    Call a function and return its result with the profile counters of the call: its wall time and the memory
+    high-water mark of the process it ran in. Submitted to a pool of processes in place of the function, it lets the
+    main process profile the work done by the workers instead of the time spent waiting for them.
+    """
+    start: float = perf_counter()
+    result = function(*args)
+    return result, {"seconds": perf_counter() - start, "rss_high_water": peak_memory()}
+
+
+class Profile:
+    """
+    The wall time, bytes read and written and rows processed of each phase (e.g., scan, rewrite, vacuum) of each file
+    or table of a run, with the high-water mark of the resident memory of the process that ran the phase at its end.
+    The high-water mark covers the life of the process up to the end of the phase, not the phase alone.
+
+    Phases done by worker processes report the time and memory of the workers (see `timed_call`).
+
+    Profiling is off until `start` is called, and phases are then no-ops. When the profile is closed, the summary is
+    written to its path, as JSON if it has a `.json` suffix and as a table otherwise, and the cProfile statistics of
+    the main process are dumped to the stats path in the pstats format.
+    """
+
+    fields: list[str] = ["calls", "seconds", "bytes_read", "bytes_written", "rows"]
+
+    def __init__(self):
+        self.enabled: bool = False
+        self.path: Optional[Path] = None
+        self.stats_path: Optional[Path] = None
+        self.phases: dict[tuple[str, str], dict[str, float]] = {}
+        self.cprofile: Optional[CProfile] = None
+        self.start_time: float = 0
+
+    def __bool__(self) -> bool:
+        return self.enabled
+
+    def start(self, path: Optional[Path], stats_path: Optional[Path] = None):
+        if not path and not stats_path:
+            return
+
+        self.enabled = True
+        self.path = path
+        self.stats_path = stats_path
+        self.start_time = perf_counter()
+        atexit_register(self.close)
+
+        if stats_path:
+            self.cprofile = CProfile()
+            self.cprofile.enable()
+
+    def phase(self, item: str, name: str) -> ContextManager[dict]:
+        """
+        Measure a phase of a file or table. The returned context gives a dictionary where the bytes_read,
+        bytes_written and rows of the phase can be set, and its seconds and rss_high_water if the phase was done by
+        another process.
+        """
+        # A new dictionary for each phase, so the values set in one phase are not seen by the next
+        return self.measure(item, name) if self.enabled else nullcontext({})
+
+    @contextmanager
+    def measure(self, item: str, name: str) -> Iterator[dict]:
+        counters: dict[str, int] = {}
+        start: float = perf_counter()
+        try:
+            yield counters
+        finally:
+            seconds: float = counters.pop("seconds", perf_counter() - start)
+            self.add(item, name, seconds, **counters)
+
+    def add(self, item: str, name: str, seconds: float = 0, bytes_read: int = 0, bytes_written: int = 0,
+            rows: int = 0, rss_high_water: Optional[int] = None):
+        if not self.enabled:
+            return
+
+        phase: dict[str, float] = self.phases.setdefault((item, name), dict.fromkeys(self.fields, 0))
+        phase["calls"] += 1
+        phase["seconds"] += seconds
+        phase["bytes_read"] += bytes_read
+        phase["bytes_written"] += bytes_written
+        phase["rows"] += rows
+        memory: list[int] = [m for m in (phase.get("rss_high_water"), rss_high_water or peak_memory()) if m]
+        phase["rss_high_water"] = max(memory, default=None)
+
+    def summary(self) -> dict:
+        totals: dict[str, dict[str, float]] = {}
+        for (_, name), phase in self.phases.items():
+            total = totals.setdefault(name, dict.fromkeys(self.fields, 0))
+            for field in self.fields:
+                total[field] += phase[field]
+
+        return {
+            "seconds": perf_counter() - self.start_time,
+            "peak_memory": peak_memory(),
+            "phases": [{"item": item, "phase": name, **phase} for (item, name), phase in self.phases.items()],
+            "totals": [{"phase": name, **total} for name, total in totals.items()],
+        }
+
+    def close(self):
+        if not self.enabled:
+            return
+
+        self.enabled = False
+
+        if self.cprofile:
+            self.cprofile.disable()
+            self.cprofile.dump_stats(self.stats_path)
+
+        if not self.path:
+            return
+
+        summary: dict = self.summary()
+
+        with self.path.open("w", encoding="utf-8") as fh:
+            if self.path.suffix.lower() == ".json":
+                fh.write(dumps(summary, indent=2, ensure_ascii=False))
+                return
+
+            mb = (lambda b: f"{b / 1_000_000:.1f}" if b is not None else "-")
+            fh.write(f"{'Item':<40} {'Phase':<12} {'Calls':>7} {'Seconds':>10} {'Read MB':>10} {'Written MB':>10} "
+                     f"{'Rows':>12} {'RSS HWM MB':>10}\n")
+            for phase in summary["phases"] + [{"item": "total", "rss_high_water": None, **t}
+                                              for t in summary["totals"]]:
+                fh.write(f"{phase['item']:<40} {phase['phase']:<12} {phase['calls']:>7} {phase['seconds']:>10.3f} "
+                         f"{mb(phase['bytes_read']):>10} {mb(phase['bytes_written']):>10} {phase['rows']:>12} "
+                         f"{mb(phase['rss_high_water']):>10}\n")
+            fh.write(f"\nTotal {summary['seconds']:.3f} seconds, peak memory {mb(summary['peak_memory'])} MB\n")
+
+
+# The profile of the running command, started by its command line interface
+profile: Profile = Profile()
+
+
+def profile_arguments(parser: ArgumentParser):
+    parser.add_argument("--profile", type=Path, default=None,
+                        help="write the time, bytes, rows and memory high-water mark of each phase of each file or "
+                             "table to a file (as JSON if its suffix is .json)")
+    parser.add_argument("--profile-stats", type=Path, default=None,
+                        help="write the cProfile statistics of the main process to a file")
+
+
+def file_copy_range(fi: BinaryIO, fo: BinaryIO, offset: int):
+    """
+    Append the contents of fi from offset to the end of the file to fo.
+
+    The data is copied by the kernel with `copy_file_range` (which can share blocks on file systems that support
+    reflinks) or `sendfile` when available, and read and written in chunks otherwise.
+    """
+    fo.flush()
+    size: int = os.fstat(fi.fileno()).st_size
+    copy_functions: list[Callable[[int], int]] = []
+
+    if hasattr(os, "copy_file_range"):
+        copy_functions.append(lambda n: os.copy_file_range(fi.fileno(), fo.fileno(), n, offset))
+    if hasattr(os, "sendfile"):
+        copy_functions.append(lambda n: os.sendfile(fo.fileno(), fi.fileno(), offset, n))
+
+    for copy_function in copy_functions:
+        try:
+            while offset < size:
+                copied: int = copy_function(min(size - offset, 1 << 30))
+                if not copied:
+                    break
+                offset += copied
+            break
+        except OSError:
+            continue
+
+    fo.seek(0, SEEK_END)
+    fi.seek(offset)
+    copyfileobj(fi, fo, 10_000_000)
@@ -1,15 +1,29 @@
 import argparse
-from glob import glob
+from concurrent.futures import ThreadPoolExecutor
+import json
 import os
 import shutil
 import sqlite3
 import traceback
+from time import perf_counter
+from typing import Optional
 from typing import Union
 from pathlib import Path
 from dataclasses import dataclass
 
+from ..common.main import profile
+from ..common.main import profile_arguments
+
+try:
+    from fcntl import ioctl
+except ImportError:  # not available on Windows
+    ioctl = None
+
 DRY = False
 
+FICLONE = 0x40049409  # Linux ioctl to clone a file on copy-on-write filesystems
+LINK_MODES = ("copy", "hardlink", "reflink", "symlink")
+
 parser = argparse.ArgumentParser(
     description="Easily compare files between original, master and statutory"
 )
@@ -32,6 +46,31 @@ parser.add_argument(
 parser.add_argument(
     "--digiarch", action="store_true", help="generate metadata folder with digiarch"
 )
+parser.add_argument(
+    "--index",
+    action="store_true",
+    help="create an index in the files db to speed up repeated runs",
+)
+parser.add_argument(
+    "--jobs", type=int, default=1, help="number of files to copy in parallel"
+)
+parser.add_argument(
+    "--link-mode",
+    choices=LINK_MODES,
+    default="copy",
+    help="how to output the files, hardlink and reflink avoid duplicating data on the same filesystem",
+)
+parser.add_argument(
+    "--index-snapshot",
+    default="",
+    help="(optional) file to save the index of the master and statutory directories in and reuse it from",
+)
+parser.add_argument(
+    "--incremental",
+    action="store_true",
+    help="only output new or changed samples and remove the samples of PUIDs that no longer exist",
+)
+profile_arguments(parser)
 # parser.add_argument("--silent", action="store_true", help="only print errors")
 
 
@@ -49,8 +88,9 @@ class PUIDFolder:
 
 
 class PUIDFolders:
-    def __init__(self, path: str) -> None:
+    def __init__(self, path: str, index: bool = False) -> None:
         self.path = path
+        self.index = index
 
         self._puids: list[PUIDFolder] = []
 
@@ -67,32 +107,59 @@ class PUIDFolders:
             return self._puids
 
         print(f"Collecting puid data from {self.path}")
-        # conn: sqlite3.Connection = None
+        conn = None
         try:
             conn = sqlite3.connect(self.db_path)
             cur = conn.cursor()
 
-            stmts = [
-                "SELECT id, relative_path, puid, min(file_size_in_bytes) FROM Files WHERE is_binary=1 GROUP BY puid",
-                "SELECT id, relative_path, puid, max(file_size_in_bytes) FROM Files WHERE is_binary=1 GROUP BY puid",
-            ]
-
-            results = []
-            for s in stmts:
-                cur.execute(s)
-                results.append(cur.fetchall())
-
-            for (id_min, path_min, puid_min, size_min), (
-                id_max,
-                path_max,
-                puid_max,
-                size_max,
-            ) in zip(*results):
-                if not puid_min:
-                    continue
-                p = PUIDFolder(
-                    puid_min, path_min, "" if path_max == path_min else path_max
+            if self.index:
+                cur.execute(
+                    "CREATE INDEX IF NOT EXISTS idx_files_binary_puid_size"
+                    " ON Files (is_binary, puid, file_size_in_bytes, relative_path)"
+                )
+                conn.commit()
+
+            indexed = cur.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'idx_files_binary_puid_size'"
+            ).fetchone()
+
+            if indexed:
+                # look up the first and last file of each puid in the index, ordered by size and then
+                # path like the aggregate below, so both pick the same files
+                cur.execute(
+                    """
+                    SELECT p.puid,
+                           (SELECT f.relative_path FROM Files f
+                            WHERE f.is_binary = 1 AND f.puid = p.puid AND f.file_size_in_bytes IS NOT NULL
+                            ORDER BY f.file_size_in_bytes, f.relative_path LIMIT 1),
+                           (SELECT f.relative_path FROM Files f
+                            WHERE f.is_binary = 1 AND f.puid = p.puid AND f.file_size_in_bytes IS NOT NULL
+                            ORDER BY f.file_size_in_bytes DESC, f.relative_path DESC LIMIT 1)
+                    FROM (
+                        SELECT DISTINCT puid FROM Files
+                        WHERE is_binary = 1 AND puid IS NOT NULL AND puid != '' AND file_size_in_bytes IS NOT NULL
+                    ) p
+                    ORDER BY p.puid
+                    """
+                )
+            else:
+                # a single pass over the table, the size is prefixed to the path so that
+                # min and max return the path of the smallest and biggest file (the lowest
+                # and highest path among files of the same size)
+                cur.execute(
+                    """
+                    SELECT puid,
+                           substr(min(printf('%020d', file_size_in_bytes) || relative_path), 21),
+                           substr(max(printf('%020d', file_size_in_bytes) || relative_path), 21)
+                    FROM Files
+                    WHERE is_binary = 1 AND puid IS NOT NULL AND puid != '' AND file_size_in_bytes IS NOT NULL
+                    GROUP BY puid
+                    ORDER BY puid
+                    """
                 )
+
+            for puid, path_min, path_max in cur:
+                p = PUIDFolder(puid, path_min, "" if path_max == path_min else path_max)
                 p.smallest_doc_path = Path(p.smallest).parent
                 p.smallest = os.path.join(self.path, p.smallest)
                 p.biggest_doc_path = Path(p.biggest).parent
@@ -110,13 +177,236 @@ class PUIDFolders:
         return self._puids
 
 
-def output_files(root: str, folders: list[PUIDFolder], others: dict[str, str]):
+class DirectoryIndex:
+    """
+    Index of the files in every directory of a tree, so that the files of a document can be found without listing its
+    directory again
+
+    The modification time of each directory is kept with its files, so an index loaded from a snapshot lists the
+    directories that changed since the snapshot was taken again when they are looked up
+    """
+
+    def __init__(
+        self,
+        root: str,
+        directories: dict[str, list[str]],
+        mtimes: dict[str, int],
+        snapshot: bool = False,
+    ) -> None:
+        self.root = root
+        self.directories = directories
+        self.mtimes = mtimes
+        self.snapshot = snapshot  # loaded from a snapshot, which may be out of date
+
+    @staticmethod
+    def key(path: Union[str, Path]) -> str:
+        return os.path.normcase(os.path.normpath(path))
+
+    @staticmethod
+    def walk(root: str, top: str) -> tuple[dict[str, list[str]], dict[str, int]]:
+        """
+        List the files in a directory and all its subdirectories, skipping hidden files like glob does, and get the
+        modification times of the directories
+        """
+        directories: dict[str, list[str]] = {}
+        mtimes: dict[str, int] = {}
+        stack = [top]
+
+        while stack:
+            path = stack.pop()
+            files = []
+            try:
+                mtime = os.stat(os.path.join(root, path)).st_mtime_ns
+                with os.scandir(os.path.join(root, path)) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(os.path.join(path, entry.name))
+                        elif not entry.name.startswith(".") and entry.is_file():
+                            files.append(entry.name)
+            except OSError:
+                continue
+            if files:
+                directories[DirectoryIndex.key(path)] = files
+                mtimes[DirectoryIndex.key(path)] = mtime
+
+        return directories, mtimes
+
+    @classmethod
+    def build(cls, root: str, jobs: int = 1) -> "DirectoryIndex":
+        """
+        Walk the tree once, with the top-level directories in parallel
+        """
+        directories: dict[str, list[str]] = {}
+        mtimes: dict[str, int] = {}
+        tops: list[str] = []
+        files: list[str] = []
+
+        mtime = os.stat(root).st_mtime_ns
+        with os.scandir(root) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    tops.append(entry.name)
+                elif not entry.name.startswith(".") and entry.is_file():
+                    files.append(entry.name)
+        if files:
+            directories[cls.key(".")] = files
+            mtimes[cls.key(".")] = mtime
+
+        with ThreadPoolExecutor(max(jobs, 1)) as executor:
+            for result_directories, result_mtimes in executor.map(
+                lambda t: cls.walk(root, t), tops
+            ):
+                directories.update(result_directories)
+                mtimes.update(result_mtimes)
+
+        return cls(root, directories, mtimes)
+
+    def changed(self, doc_path: Union[str, Path]) -> bool:
+        """
+        Check if a directory was changed, created or removed since it was indexed
+        """
+        try:
+            mtime = os.stat(os.path.join(self.root, doc_path)).st_mtime_ns
+        except OSError:
+            return self.key(doc_path) in self.directories
+        return mtime != self.mtimes.get(self.key(doc_path))
+
+    def files(self, doc_path: Union[str, Path]) -> list[str]:
+        """
+        Get the paths of the files in a directory of the tree
+        """
+        key = self.key(doc_path)
+        names = self.directories.get(key)
+        if self.snapshot and self.changed(doc_path):
+            # files may have been added to or removed from the directory since the snapshot was taken
+            directories, mtimes = self.walk(self.root, str(doc_path))
+            names = directories.get(key, [])
+            self.directories[key] = names
+            self.mtimes[key] = mtimes.get(key, 0)
+        return [os.path.join(self.root, doc_path, n) for n in names or []]
+
+
+def index_directories(
+    roots: dict[str, str], jobs: int = 1, snapshot: str = ""
+) -> dict[str, DirectoryIndex]:
+    """
+    Index the given directories, reusing and updating the snapshot file if given
+    """
+    saved: dict[str, dict[str, dict]] = {}
+    if snapshot and os.path.isfile(snapshot):
+        with open(snapshot, encoding="utf-8") as fh:
+            saved = json.load(fh)
+
+    indices: dict[str, DirectoryIndex] = {}
+    for name, root in roots.items():
+        if not root:
+            continue
+        root_key = os.path.abspath(root)
+        # snapshots without the modification times of the directories cannot be checked and are indexed again
+        if "mtimes" in saved.get(root_key, {}):
+            print(f"Using index of {name} from {snapshot}")
+            indices[name] = DirectoryIndex(
+                root, saved[root_key]["directories"], saved[root_key]["mtimes"], True
+            )
+        else:
+            print(f"Indexing {name} at {root}")
+            with profile.phase(name, "index") as counters:
+                indices[name] = DirectoryIndex.build(root, jobs)
+                counters["rows"] = len(indices[name].directories)
+            saved[root_key] = {
+                "directories": indices[name].directories,
+                "mtimes": indices[name].mtimes,
+            }
+
+    if snapshot:
+        with open(snapshot, "w", encoding="utf-8") as fh:
+            json.dump(saved, fh)
+
+    return indices
+
+
+def reflink(src: str, dst: str):
+    """
+    Clone a file on a copy-on-write filesystem, or copy it where cloning is not supported
+    """
+    if ioctl is None:
+        shutil.copy2(src, dst)
+        return
+
+    try:
+        with open(src, "rb") as fs, open(dst, "wb") as fd:
+            ioctl(fd.fileno(), FICLONE, fs.fileno())
+    except OSError:
+        shutil.copy2(src, dst)
+        return
+
+    shutil.copystat(src, dst)
+
+
+def output_file(
+    src: str, dst: str, link_mode: str = "copy", previous: Optional[dict] = None
+) -> tuple[dict, bool]:
+    """
+    Output a single file by copying or linking it, unless it is unchanged since it was output as previous.
+    Returns the manifest entry of the file and whether it was output.
+    """
+    stat = os.stat(src)
+    entry = {
+        "source": os.path.abspath(src),
+        "size": stat.st_size,
+        "mtime": stat.st_mtime_ns,
+        "link_mode": link_mode,
+    }
+
+    if previous and os.path.lexists(dst):
+        if {k: previous.get(k) for k in entry} == entry:
+            return entry, False
+
+    # Never write through an existing path, it may be a link to a source file left by a previous run
+    if os.path.lexists(dst):
+        os.remove(dst)
+
+    if link_mode == "copy":
+        shutil.copy2(src, dst)
+    elif link_mode == "hardlink":
+        os.link(src, dst)
+    elif link_mode == "reflink":
+        reflink(src, dst)
+    elif link_mode == "symlink":
+        os.symlink(os.path.abspath(src), dst)
+    else:
+        raise ValueError(f"Unknown link mode {link_mode!r}")
+
+    return entry, True
+
+
+def output_files(
+    root: str,
+    folders: list[PUIDFolder],
+    others: dict[str, str],
+    jobs: int = 1,
+    link_mode: str = "copy",
+    snapshot: str = "",
+    incremental: bool = False,
+):
     """
     Copy over the files per PUID folder
+
+    The files that were output are recorded in a manifest in the root. In incremental mode, files whose source is
+    unchanged since they were recorded are not copied again, and recorded files that are no longer sampled are removed.
     """
     os.makedirs(root, exist_ok=True)
 
+    indices = index_directories(others, jobs, snapshot)
+
+    manifest_path = os.path.join(root, ".manifest.json")
+    manifest: dict[str, dict] = {}  # destination relative to root: entry
+    if incremental and os.path.isfile(manifest_path):
+        with open(manifest_path, encoding="utf-8") as fh:
+            manifest = json.load(fh)
+
     errs = []  # error messages
+    copies: dict[str, tuple[str, str]] = {}  # destination: source, puid
 
     print("Found", len(folders), "PUIDs to copy files for")
 
@@ -137,26 +427,97 @@ def output_files(root: str, folders: list[PUIDFolder], others: dict[str, str]):
             os.makedirs(doc_id_path, exist_ok=True)
 
             name = "smallest" if n == 0 else "biggest"
-            shutil.copy2(
-                file_path,
-                os.path.join(doc_id_path, f"original_{name}{Path(file_path).suffix}"),
-            )
+            copies[
+                os.path.join(doc_id_path, f"original_{name}{Path(file_path).suffix}")
+            ] = (file_path, p.puid)
 
             # look in others
-            for other_name, other_path in others.items():
-                if not other_path:
-                    continue
-                other_files = glob(os.path.join(other_path, doc_path, "*"))
+            for other_name, index in indices.items():
+                other_files = index.files(doc_path)
                 for f in other_files:
-                    shutil.copy2(
-                        f, os.path.join(doc_id_path, f"{other_name}{Path(f).suffix}")
-                    )
+                    copies[
+                        os.path.join(doc_id_path, f"{other_name}{Path(f).suffix}")
+                    ] = (f, p.puid)
 
                 if not other_files:
                     errs.append(
                         f"Could not find file for PUID {p.puid} in {other_name}, PUID file in question: {file_path}"
                     )
 
+    # remove the files of samples that are no longer selected, and the folders of PUIDs that no longer exist
+    if incremental:
+        puids = {p.puid for p in folders}
+        destinations = {os.path.relpath(dst, root) for dst in copies}
+        root_real = os.path.realpath(root)
+        removed = 0
+        for dst, entry in manifest.items():
+            if dst in destinations or not entry.get("puid"):
+                continue
+            # only remove PUID folders directly in the root, and files in the document folders inside them
+            puid_folder = os.path.realpath(
+                os.path.join(root, entry["puid"].replace("/", "_"))
+            )
+            if os.path.dirname(puid_folder) != root_real:
+                continue
+            path = os.path.join(root, dst)
+            folder = os.path.realpath(os.path.dirname(path))
+            if entry["puid"] not in puids:
+                if os.path.isdir(puid_folder):
+                    shutil.rmtree(puid_folder)
+                removed += 1
+            elif os.path.dirname(folder) == puid_folder and os.path.lexists(path):
+                os.remove(path)
+                if not os.listdir(folder):
+                    os.rmdir(folder)
+                removed += 1
+        if removed:
+            print("Removed", removed, "files that are no longer sampled")
+
+    # copy the files in parallel, each destination only once so that no two threads write the same file
+    output: dict[str, dict] = {}
+    skipped = 0
+    copied_bytes = 0
+    start = perf_counter()
+    with ThreadPoolExecutor(max(jobs, 1)) as executor:
+        futures = [
+            (
+                src,
+                dst,
+                puid,
+                executor.submit(
+                    output_file,
+                    src,
+                    dst,
+                    link_mode,
+                    manifest.get(os.path.relpath(dst, root)),
+                ),
+            )
+            for dst, (src, puid) in copies.items()
+        ]
+        for src, dst, puid, future in futures:
+            try:
+                entry, copied = future.result()
+            except Exception as e:
+                errs.append(f"Could not {link_mode} {src} to {dst}: {e}")
+                continue
+            output[os.path.relpath(dst, root)] = {"puid": puid, **entry}
+            skipped += not copied
+            copied_bytes += entry["size"] if copied else 0
+
+    profile.add(
+        root,
+        "copy",
+        perf_counter() - start,
+        bytes_written=copied_bytes,
+        rows=len(output) - skipped,
+    )
+
+    with open(manifest_path, "w", encoding="utf-8") as fh:
+        json.dump(output, fh, indent=2)
+
+    if skipped:
+        print("Skipped", skipped, "unchanged files")
+
     if errs:
         print("A few errors occured while copying:")
         for e in errs:
@@ -166,6 +527,7 @@ def output_files(root: str, folders: list[PUIDFolder], others: dict[str, str]):
 def main():
     # global log
     args = parser.parse_args()
+    profile.start(args.profile, args.profile_stats)
 
     # if args.silent:
     #     log = lambda *a, **kw: None
@@ -188,11 +550,19 @@ def main():
 
     # collect the data for each puid
     print("Collecting info on all files")
-    puidfolders = PUIDFolders(args.original)
-    puids = puidfolders.collect()
+    puidfolders = PUIDFolders(args.original, args.index)
+    with profile.phase(args.original, "collect") as counters:
+        puids = puidfolders.collect()
+        counters["rows"] = len(puids)
     print("Copying files to puid-folders")
     output_files(
-        args.output, puids, {"master": args.master, "statutory": args.statutory}
+        args.output,
+        puids,
+        {"master": args.master, "statutory": args.statutory},
+        args.jobs,
+        args.link_mode,
+        args.index_snapshot,
+        args.incremental,
     )
 
     print("Finished!")
@@ -1,67 +1,291 @@
 import re
 from argparse import ArgumentParser
+from codecs import getincrementaldecoder
+from concurrent.futures import Future
+from concurrent.futures import ProcessPoolExecutor
+from csv import writer as csv_writer
+from functools import lru_cache
+from json import dumps
 from pathlib import Path
 from shutil import get_terminal_size
+from typing import Iterable
+from typing import Iterator
+from typing import Optional
+from typing import TextIO
 from zipfile import ZipFile
 
+from xmltodict import parse as parse_xml
+
+from ..common.main import profile
+from ..common.main import profile_arguments
+from ..common.main import timed_call
+
+
+@lru_cache
+def expressions(ignore: str) -> tuple[re.Pattern, re.Pattern]:
+    """
+    Compile the expressions for the general match and to capture the specific characters.
+    """
+    return (
+        re.compile(fr"(?<=>)[^<>]*(\w+[^\x20-\x7e{ignore}]+\w+)[^<>]*(?=<)"),
+        re.compile(fr"(?<=\w)([^\x20-\x7e{ignore}]+)(?=\w)"),
+    )
+
+
+def scan_chunks(chunks: Iterable[bytes], ignore: str) -> Iterator[tuple[int, int, str]]:
+    """
+    Find the text between tags with unusual character sequences in a stream of UTF-8 encoded XML.
+
+    The chunks are decoded incrementally and only searched up to their last `<`. The text from that character on is
+    kept for the next chunk, so text between tags is never split, and the start and end of the matches are character
+    offsets in the whole decoded text.
+    """
+    expression, _ = expressions(ignore)
+    decoder = getincrementaldecoder("utf-8")()
+    text: str = ""
+    offset: int = 0
+
+    for chunk in chunks:
+        text += decoder.decode(chunk)
+        end: int = text.rfind("<")
+
+        if end < 0:
+            continue
+
+        for match in expression.finditer(text, 0, end + 1):
+            yield offset + match.start(), offset + match.end(), match.group(0)
+
+        offset += end
+        text = text[end:]
+
+    text += decoder.decode(b"", final=True)
+
+    for match in expression.finditer(text):
+        yield offset + match.start(), offset + match.end(), match.group(0)
+
+
+def scan_odf(file: Path, ignore: str, chunk_size: int = 1_000_000) -> list[tuple[int, int, str]]:
+    """
+    Find the unusual character sequences in the content.xml file of an Open Document file.
+    """
+    with ZipFile(file, "r") as file_zip, file_zip.open("content.xml", "r") as fh:
+        return list(scan_chunks(iter(lambda: fh.read(chunk_size), b""), ignore))
+
+
+def scan_table(file: Path, ignore: str, chunk_size: int = 10_000_000) -> list[tuple[int, str, str]]:
+    """
+    Find the unusual character sequences in a table XML file of an archive.
+
+    The file is read in chunks of complete rows, so memory is bounded by the chunk size and the largest row. Each match
+    is returned with its row number (starting at 1), the ID of its column, and the text of the column.
+    """
+    expression, _ = expressions(ignore)
+    matches: list[tuple[int, str, str]] = []
+    buffer: bytes = b""
+    rows: int = 0
+
+    with file.open("rb") as fh:
+        while True:
+            chunk: bytes = fh.read(chunk_size)
+            buffer += chunk
+
+            # Only search complete rows, which always end with a complete character, unless the file is finished
+            end: int = (buffer.rfind(b"</row>") + 6) if chunk else len(buffer)
+            if end < 6 and chunk:
+                continue
+
+            text: str = buffer[:end].decode()
+            row_index: int = 0
+
+            for match in expression.finditer(text):
+                rows += text.count("</row>", row_index, match.start())
+                row_index = match.start()
+                column: Optional[re.Match] = re.match(r"<(c\d+)", text[text.rfind("<c", 0, match.start()):])
+                matches.append((rows + 1, column.group(1) if column else "", match.group(0)))
+
+            rows += text.count("</row>", row_index)
+            buffer = buffer[end:]
+
+            if not chunk:
+                break
+
+    return matches
+
+
+def archive_tables(archive: Path) -> list[tuple[Path, str, dict[str, str]]]:
+    """
+    Get the path, the name and the names of the columns of each table in an archive from its tableIndex.xml.
+    """
+    tables_index: dict = parse_xml(archive.joinpath("Indices", "tableIndex.xml").read_bytes(), force_list=True)
+
+    return [
+        (archive.joinpath("tables", t["folder"][0], t["folder"][0]).with_suffix(".xml"),
+         t["name"][0],
+         {c["columnID"][0]: c["name"][0] for c in t["columns"][0]["column"]})
+        for t in tables_index["siardDiark"][0]["tables"][0]["table"]
+    ]
+
+
+class Report:
+    """
+    A machine-readable report of the matches, written as CSV or as a JSON array depending on the suffix of its path.
+
+    Matches are written as they are added, so the report does not grow in memory.
+    """
+
+    fields: list[str] = ["file", "table", "table_name", "row", "column", "column_name", "start", "end", "characters",
+                         "match"]
+
+    def __init__(self, path: Path):
+        self.path: Path = path
+        self.json: bool = path.suffix.lower() == ".json"
+        self.handle: TextIO = path.open("w", encoding="utf-8", newline="")
+        self.count: int = 0
+
+        if self.json:
+            self.handle.write("[")
+        else:
+            self.csv = csv_writer(self.handle)
+            self.csv.writerow(self.fields)
+
+    def add(self, **values):
+        row: dict = {f: values.get(f) for f in self.fields}
+
+        if self.json:
+            self.handle.write(("," if self.count else "") + "\n  " + dumps(row, ensure_ascii=False))
+        else:
+            self.csv.writerow(["" if v is None else v for v in row.values()])
+
+        self.count += 1
+
+    def close(self):
+        if self.json:
+            self.handle.write("\n]\n" if self.count else "]\n")
+        self.handle.close()
+
+
+def is_archive(path: Path) -> bool:
+    return path.joinpath("Indices", "tableIndex.xml").is_file()
+
 
 # noinspection SpellCheckingInspection
-def main(files: list[Path], ignore: str):
+def main(files: list[Path], ignore: str, jobs: int = 1, report_file: Optional[Path] = None):
     """
-    Take a list of Open Document files and check the text inside the content.xml file for unusual character sequences.
+    Take a list of Open Document files or archives and check the text inside the content.xml file of each document
+    or the table files of each archive for unusual character sequences.
 
     The characters are searched within tags, they must be surrounded by ASCII characters
     and not included in the optional `ignore` argument.
     """
 
-    # Compile the expressions for the general match and to capture the specific characters
-    expression = re.compile(fr"(?<=>)[^<>]*(\w+[^\x20-\x7e{ignore}]+\w+)[^<>]*(?=<)")
-    expression_single = re.compile(fr"(?<=\w)([^\x20-\x7e{ignore}]+)(?=\w)")
+    _, expression_single = expressions(ignore)
     terminal_size = get_terminal_size((0, 0)).columns
     file: Path
 
-    for i, file in enumerate(files, 1):
-        # Ensure that the file has an Open Document extension
-        if file.suffix not in (".odt", ".ods", ".odp"):
-            raise Exception(f"File {file!r} is not an Open Document file")
+    # Ensure that the files have an Open Document extension or are archives
+    for file in files:
+        if file.suffix not in (".odt", ".ods", ".odp") and not is_archive(file):
+            raise Exception(f"File {file!r} is not an Open Document file or an archive")
 
-        # Print the file path and a horizontal line
-        #   with minimum length equal to the table header but smaller than the terminal width
-        print(file)
-        hr = min(len(str(file)), terminal_size)
-        hr = max(hr, 9 + 3 + 9 + 3 + 5)
-        print("-" * hr)
+    tables: dict[Path, list[tuple[Path, str, dict[str, str]]]] = {f: archive_tables(f) for f in files if is_archive(f)}
+    executor: Optional[ProcessPoolExecutor] = ProcessPoolExecutor(jobs) if jobs > 1 else None
+    futures: dict[Path, Future] = {}
+    report: Optional[Report] = Report(report_file) if report_file else None
 
-        # Open file as zip and extract text from content.xml file inside it
-        file_zip = ZipFile(file, "r")
-        text = file_zip.open("content.xml", "r").read().decode()
+    # Submit the table files largest first, and the Open Document files in order
+    for path in sorted((t for ts in tables.values() for t, _, _ in ts if t.is_file()) if executor else [],
+                       key=lambda t: t.stat().st_size, reverse=True):
+        futures[path] = executor.submit(timed_call, scan_table, path, ignore)
+    for file in (files if executor else []):
+        if file not in tables:
+            futures[file] = executor.submit(timed_call, scan_odf, file, ignore)
 
-        # Match the expression for unusual characters
-        matches = list(expression.finditer(text))
+    try:
+        for i, file in enumerate(files, 1):
+            # Print the file path and a horizontal line
+            #   with minimum length equal to the table header but smaller than the terminal width
+            print(file)
+            hr = min(len(str(file)), terminal_size)
+            hr = max(hr, 9 + 3 + 9 + 3 + 5)
+            print("-" * hr)
 
-        if not matches:
-            print("No errors found in file.")
-        else:
-            print(f"{'Start':<9} | {'End':<9} | Match")
+            if file in tables:
+                found: bool = False
+
+                for path, table_name, column_names in tables[file]:
+                    if not path.is_file():
+                        print(f"{path.stem:<9} | table file not found")
+                        continue
 
-        for match in matches:
-            # Highlight the unusual characters with bold (1), red (31) text.
-            match_highlight = expression_single.sub("\x1b[31;1m" + r"\1" + "\x1b[0m", match.group(0))
+                    with profile.phase(f"{file.name}/{path.stem}", "scan") as counters:
+                        if executor:
+                            matches, worker_counters = futures[path].result()
+                            counters.update(worker_counters)
+                        else:
+                            matches: list[tuple[int, str, str]] = scan_table(path, ignore)
+                        counters["bytes_read"] = path.stat().st_size if profile else 0
 
-            # Print the start and end of the match and the highlighted match within the terminal width.
-            print(f"{match.span()[0]:<9} | {match.span()[1]:<9} | {match_highlight} "[:terminal_size or -1])
+                    if matches and not found:
+                        print(f"{'Table':<9} | {'Row':<9} | {'Column':<9} | Match")
+                    found = found or bool(matches)
 
-        # Print an extra newline if the file is not the last
-        if i < len(files):
-            print()
+                    for row, column, text in matches:
+                        match_highlight = expression_single.sub("\x1b[31;1m" + r"\1" + "\x1b[0m", text)
+                        print(f"{path.stem:<9} | {row:<9} | {column:<9} | {match_highlight} "[:terminal_size or -1])
+
+                        if report:
+                            report.add(file=str(file), table=path.stem, table_name=table_name, row=row,
+                                       column=column, column_name=column_names.get(column),
+                                       characters="".join(expression_single.findall(text)), match=text)
+
+                if not found:
+                    print("No errors found in archive.")
+            else:
+                # Stream the text of the content.xml file and match the expression for unusual characters
+                with profile.phase(file.name, "scan") as counters:
+                    if executor:
+                        matches, worker_counters = futures[file].result()
+                        counters.update(worker_counters)
+                    else:
+                        matches: list[tuple[int, int, str]] = scan_odf(file, ignore)
+                    counters["bytes_read"] = file.stat().st_size if profile else 0
+
+                if not matches:
+                    print("No errors found in file.")
+                else:
+                    print(f"{'Start':<9} | {'End':<9} | Match")
+
+                for start, end, text in matches:
+                    # Highlight the unusual characters with bold (1), red (31) text.
+                    match_highlight = expression_single.sub("\x1b[31;1m" + r"\1" + "\x1b[0m", text)
+
+                    # Print the start and end of the match and the highlighted match within the terminal width.
+                    print(f"{start:<9} | {end:<9} | {match_highlight} "[:terminal_size or -1])
+
+                    if report:
+                        report.add(file=str(file), start=start, end=end,
+                                   characters="".join(expression_single.findall(text)), match=text)
+
+            # Print an extra newline if the file is not the last
+            if i < len(files):
+                print()
+    finally:
+        if executor:
+            executor.shutdown(cancel_futures=True)
+        if report:
+            report.close()
 
 
 def cli():
     parser = ArgumentParser("convert-encoding", description=main.__doc__)
-    parser.add_argument("files", nargs="+", type=Path, help="the files to check")
+    parser.add_argument("files", nargs="+", type=Path, help="the files or archives to check")
     parser.add_argument("--ignore", type=str, required=False, default="", help="extra characters to ignore")
+    parser.add_argument("--jobs", type=int, default=1, help="number of files or tables to check in parallel")
+    parser.add_argument("--report", type=Path, required=False, default=None,
+                        help="write the matches to a CSV or JSON (.json) file")
+    profile_arguments(parser)
 
     args = parser.parse_args()
+    profile.start(args.profile, args.profile_stats)
 
-    main(args.files, args.ignore)
-
+    main(args.files, args.ignore, args.jobs, args.report)
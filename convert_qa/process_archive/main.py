@@ -0,0 +1,332 @@
+from argparse import ArgumentParser
+from concurrent.futures import Future
+from concurrent.futures import ProcessPoolExecutor
+from functools import reduce
+from pathlib import Path
+from sqlite3 import Connection
+from typing import Callable
+from typing import Iterator
+from typing import Optional
+
+from xmltodict import parse as parse_xml
+from xmltodict import unparse as unparse_xml
+
+from ..add_primary_keys.main import rows_add_key
+from ..add_primary_keys.main import table_index_add_key
+from ..add_primary_keys.main import xsd_add_key
+from ..clean_empty_columns.main import rmdir
+from ..clean_empty_columns.main import rows_drop_columns
+from ..clean_empty_columns.main import table_cache_connect
+from ..clean_empty_columns.main import table_cache_get
+from ..clean_empty_columns.main import table_cache_path
+from ..clean_empty_columns.main import table_cache_update
+from ..clean_empty_columns.main import table_xml_header
+from ..clean_empty_columns.main import table_xml_renumber
+from ..clean_empty_columns.main import table_xml_rewrite_rows
+from ..clean_empty_columns.main import tables_index_update
+from ..clean_empty_columns.main import xml_table_stats_parallel
+from ..clean_empty_columns.main import xsd_update
+from ..common.main import Progress
+from ..common.main import print_with_file
+from ..common.main import profile
+from ..common.main import profile_arguments
+from ..common.main import timed_call
+
+
+def table_process(table_folder: Path, new_index: int, remove_columns: list[str], key_column: Optional[str]) -> Path:
+    """
+    Remove columns from a table, renumber it and add a key column to it with a single pass over its rows.
+
+    If the table is renumbered, its folder is moved to a temporary name (.tableN) that cannot collide with the
+    folders of other tables. The new path of the folder is returned.
+    """
+    index: int = int(table_folder.name.removeprefix("table"))
+    xml_path: Path = table_folder.joinpath(table_folder.name).with_suffix(".xml")
+    xsd_path: Path = xml_path.with_suffix(".xsd")
+
+    if not remove_columns and not key_column:
+        table_xml_renumber(xml_path, new_index, xml_path)
+    else:
+        rewrites: list[Callable[[bytes], bytes]] = [
+            *([rows_drop_columns(remove_columns)] if remove_columns else []),
+            *([rows_add_key(key_column)] if key_column else []),
+        ]
+
+        def rewrite(rows: bytes) -> bytes:
+            for rewrite_function in rewrites:
+                rows = rewrite_function(rows)
+            return rows
+
+        xml_path_tmp: Path = xml_path.with_name("." + xml_path.name)
+        with xml_path.open("rb") as fi, xml_path_tmp.open("wb", buffering=10_000_000) as fo:
+            fo.write(table_xml_header(new_index))
+            table_xml_rewrite_rows(fi, fo, rewrite)
+        xml_path_tmp.replace(xml_path)
+
+    xml_path.rename(xml_path.with_name(f"table{new_index}.xml"))
+
+    xsd: dict = xsd_update(parse_xml(xsd_path.read_bytes(), "utf-8", force_list=True), new_index, remove_columns)
+    xsd = xsd_add_key(xsd) if key_column else xsd
+    xsd_path_tmp: Path = xsd_path.with_name("." + xsd_path.name)
+    with xsd_path_tmp.open("w") as fh:
+        unparse_xml(xsd, fh, "utf-8")
+    xsd_path_tmp.replace(xsd_path)
+    xsd_path.rename(xsd_path.with_name(f"table{new_index}.xsd"))
+
+    if new_index == index:
+        return table_folder
+
+    return table_folder.rename(table_folder.with_name(f".table{new_index}"))
+
+
+# noinspection DuplicatedCode
+def main(archive: Path, remove_tables: list[str], remove_empty_tables: bool, clean_empty_columns: bool,
+         add_primary_keys: bool, commit: bool, log_file: Optional[Path], jobs: int = 1, cache: bool = False):
+    echo = print_with_file(log_file)
+    cache_conn: Optional[Connection] = table_cache_connect(table_cache_path(archive)) if cache else None
+
+    print(archive.name)
+
+    tables_index_path: Path = archive.joinpath("Indices", "tableIndex.xml")
+    tables_index: dict = parse_xml(tables_index_path.read_text("utf-8"), force_list=True)
+    tables: list[dict] = sorted(tables_index["siardDiark"][0]["tables"][0]["table"],
+                                key=lambda t: int(t["folder"][0].removeprefix("table")))
+    table_ids: list[int] = [int(t.lower().removeprefix("table")) for t in remove_tables]
+
+    if remove_empty_tables:
+        table_ids.extend(int(t["folder"][0].removeprefix("table")) for t in tables if t["rows"][0] == "0")
+
+    tables_to_remove: list[int] = [
+        i for i in (int(t["folder"][0].removeprefix("table")) for t in tables) if i in table_ids
+    ]
+    columns_to_remove: list[tuple[int, set[str]]] = []
+    keys_to_add: list[int] = []
+    tables_stats: dict[int, tuple[list[str], set[str], Optional[int]]] = {}
+
+    if clean_empty_columns:
+        tables_scan: list[dict] = [
+            t for t in tables if int(t["folder"][0].removeprefix("table")) not in tables_to_remove
+        ]
+        tables_paths: list[Path] = [
+            archive.joinpath("tables", t["folder"][0], t["folder"][0]).with_suffix(".xml") for t in tables_scan
+        ]
+        tables_sizes: list[int] = [p.stat().st_size if p.is_file() else 0 for p in tables_paths]
+        scans: Iterator[tuple[set[str], Optional[int], dict]] = xml_table_stats_parallel(
+            [(p, [c["columnID"][0] for c in t["columns"][0]["column"]]) for p, t in zip(tables_paths, tables_scan)],
+            jobs,
+            cache_conn
+        )
+        progress: Progress = Progress(sum(tables_sizes))
+
+        try:
+            for table, table_size in zip(tables_scan, tables_sizes):
+                progress.update(f"{archive.name}/{table['folder'][0]}/{table['name'][0]}")
+                columns: list[dict] = table["columns"][0]["column"]
+                with profile.phase(f"{archive.name}/{table['folder'][0]}", "scan") as counters:
+                    empty_columns, rows, worker_counters = next(scans)
+                    counters.update(worker_counters, bytes_read=table_size, rows=rows or 0)
+                progress.update(advance=table_size)
+                tables_stats[int(table["folder"][0].removeprefix("table"))] = \
+                    ([c["columnID"][0] for c in columns], empty_columns, rows)
+
+                if len(empty_columns) == len(columns):
+                    tables_to_remove.append(int(table["folder"][0].removeprefix("table")))
+                    progress.clear()
+                    echo(f"{archive.name}/{table['folder'][0]}/{table['name'][0]}/empty",
+                         event={"file": archive.name, "table": table["folder"][0], "action": "empty"})
+                elif empty_columns:
+                    columns_to_remove.append((int(table["folder"][0].removeprefix("table")), empty_columns))
+                    progress.clear()
+                    for column in [c for c in columns if c["columnID"][0] in empty_columns]:
+                        echo(f"{archive.name}/{table['folder'][0]}/{table['name'][0]}/"
+                             f"{column['columnID'][0]}/{column['name'][0]}/empty",
+                             event={"file": archive.name, "table": table["folder"][0], "column": column["columnID"][0],
+                                    "action": "empty"})
+        finally:
+            progress.close()
+            scans.close()
+        tables_to_remove.sort()
+
+    if add_primary_keys:
+        keys_to_add = [
+            i for i in (int(t["folder"][0].removeprefix("table")) for t in tables
+                        if t["primaryKey"][0]["name"][0].lower() == "missing")
+            if i not in tables_to_remove
+        ]
+
+    if not commit or not (tables_to_remove or columns_to_remove or keys_to_add):
+        print(f"{archive.name}/{len(tables_to_remove)} tables and "
+              f"{len([c for _, cs in columns_to_remove for c in cs])} columns to remove, "
+              f"{len(keys_to_add)} keys to add")
+        if cache_conn:
+            cache_conn.close()
+        return
+
+    columns_to_remove_dict: dict[int, set[str]] = dict(columns_to_remove)
+    moves: dict[int, Future] = {}
+    executor: Optional[ProcessPoolExecutor] = ProcessPoolExecutor(jobs) if jobs > 1 else None
+
+    def plan(table: dict) -> Optional[tuple[Path, int, list[str], Optional[str]]]:
+        index: int = int(table["folder"][0].removeprefix("table"))
+        table_folder: Path = archive.joinpath("tables", table["folder"][0])
+        new_index: int = index - reduce(lambda p, c: (p + 1) if c < index else p, tables_to_remove, 0)
+        remove_columns: list[str] = sorted(columns_to_remove_dict.get(index, set()),
+                                           key=lambda c: int(c.removeprefix("c")))
+        key_column: Optional[str] = None
+
+        if index in keys_to_add:
+            key_column = f'c{len(table["columns"][0]["column"]) - len(remove_columns) + 1}'
+
+        if index in tables_to_remove or (new_index == index and not remove_columns and not key_column):
+            return None
+
+        return table_folder, new_index, remove_columns, key_column
+
+    try:
+        plans: dict[int, tuple[Path, int, list[str], Optional[str]]] = {}
+
+        for table in tables:
+            args = plan(table)
+            if args and args[0].is_dir():
+                plans[int(table["folder"][0].removeprefix("table"))] = args
+
+        # Read the cached statistics of the tables that were not scanned before their files are changed
+        for index in (plans if cache_conn else []):
+            if index not in tables_stats:
+                entry = table_cache_get(cache_conn, plans[index][0].joinpath(f"{plans[index][0].name}.xml"))
+                if entry:
+                    tables_stats[index] = entry
+
+        plans_sizes: dict[int, int] = {
+            i: p[0].joinpath(f"{p[0].name}.xml").stat().st_size if p[0].joinpath(f"{p[0].name}.xml").is_file() else 0
+            for i, p in plans.items()
+        }
+
+        # Start processing the tables in parallel, largest tables first
+        for index in sorted(plans if executor else [], key=lambda i: plans_sizes[i], reverse=True):
+            moves[index] = executor.submit(timed_call, table_process, *plans[index])
+
+        staged: list[Path] = []
+        progress: Progress = Progress(sum(plans_sizes.values()))
+
+        for table in tables:
+            index: int = int(table["folder"][0].removeprefix("table"))
+            table_folder: Path = archive.joinpath("tables", table["folder"][0])
+            args = plan(table)
+
+            if index in tables_to_remove:
+                progress.clear()
+                echo(f"{archive.name}/{table['folder'][0]}/{table['name'][0]}/removed",
+                     event={"file": archive.name, "table": table["folder"][0], "action": "removed"})
+                with profile.phase(f"{archive.name}/{table['folder'][0]}", "remove"):
+                    rmdir(table_folder)
+                continue
+            elif not args:
+                continue
+            elif index not in moves and not table_folder.is_dir():
+                progress.clear()
+                echo(f"{archive.name}/{table['folder'][0]}/{table['name'][0]}/folder not found",
+                     event={"file": archive.name, "table": table["folder"][0], "action": "not found"})
+                continue
+
+            _, new_index, remove_columns, key_column = args
+
+            progress.update(f"{archive.name}/{table['folder'][0]}/{table['name'][0]}/processing")
+
+            with profile.phase(f"{archive.name}/{table['folder'][0]}", "rewrite") as counters:
+                if index in moves:
+                    table_folder, worker_counters = moves[index].result()
+                    counters.update(worker_counters)
+                else:
+                    table_folder = table_process(*args)
+                if profile:
+                    counters["bytes_written"] = table_folder.joinpath(f"table{new_index}.xml").stat().st_size
+            if table_folder.name.startswith("."):
+                staged.append(table_folder)
+
+            progress.update(advance=plans_sizes.get(index, 0))
+            progress.clear()
+            for column in remove_columns:
+                echo(f"{archive.name}/{table['folder'][0]}/{table['name'][0]}/{column}/removed",
+                     event={"file": archive.name, "table": table["folder"][0], "column": column, "action": "removed"})
+            if new_index != index:
+                echo(f"{archive.name}/{table['folder'][0]}/{table['name'][0]}/moved to table{new_index}",
+                     event={"file": archive.name, "table": table["folder"][0], "action": "moved",
+                            "value": f"table{new_index}"})
+            if key_column:
+                echo(f"{archive.name}/{table['folder'][0]}/{table['name'][0]}/added {key_column} aca_id__",
+                     event={"file": archive.name, "table": table["folder"][0], "column": key_column,
+                            "action": "added"})
+
+        progress.close()
+
+        # Move the folders from their temporary names to their final names
+        with profile.phase(archive.name, "rename"):
+            for table_folder in staged:
+                table_folder.rename(table_folder.with_name(table_folder.name.removeprefix(".")))
+
+        tables_index_new: dict = tables_index_update(tables_index, columns_to_remove, tables_to_remove)
+        keys_to_add_new: list[int] = [
+            k - reduce(lambda p, c: (p + 1) if c < k else p, tables_to_remove, 0) for k in keys_to_add
+        ]
+
+        for table in tables_index_new["siardDiark"][0]["tables"][0]["table"]:
+            if int(table["folder"][0].removeprefix("table")) in keys_to_add_new:
+                table_index_add_key(table)
+
+        with profile.phase(archive.name, "index"), tables_index_path.open("wb") as fh:
+            unparse_xml(tables_index_new, fh, "utf-8")
+
+        if cache_conn:
+            with profile.phase(archive.name, "cache"):
+                table_cache_update(cache_conn, archive, tables_stats, columns_to_remove, tables_to_remove,
+                                   keys_to_add)
+
+        print(f"{archive.name}/{len(tables_to_remove)} tables "
+              f"and {len([c for _, cs in columns_to_remove for c in cs])} columns removed, "
+              f"{len(keys_to_add)} keys added")
+    except (Exception, BaseException) as err:
+        print()
+        echo("ERROR: The operation was interrupted before all changes could be written.",
+             f"Archive {archive.name} is likely corrupted.", event={"file": archive.name, "action": "error"})
+        print()
+        raise err
+    finally:
+        if executor:
+            executor.shutdown(cancel_futures=True)
+        if cache_conn:
+            cache_conn.close()
+
+
+def cli():
+    """
+    Remove tables, remove empty columns and add missing primary keys to an archive with a single pass over each table.
+
+    The result is the same as running remove-tables, clean-empty-columns and add-primary-keys one after the other,
+    but each table file and tableIndex.xml are only read and written once.
+
+    Changes are written only if the `--commit` option is used and are otherwise ignored.
+    """
+
+    parser = ArgumentParser("process-archive", description=cli.__doc__)
+    parser.add_argument("archive", type=Path, help="the path to the archive")
+    parser.add_argument("--remove-tables", nargs="+", default=[], metavar="TABLE", help="the tables to remove")
+    parser.add_argument("--remove-empty-tables", action="store_true", help="remove all empty tables")
+    parser.add_argument("--clean-empty-columns", action="store_true",
+                        help="remove empty columns and tables where all columns are empty")
+    parser.add_argument("--add-primary-keys", action="store_true", help="add missing primary keys")
+    parser.add_argument("--commit", action="store_true", required=False, help="commit changes to archive")
+    parser.add_argument("--jobs", type=int, default=1, help="number of tables to process in parallel")
+    parser.add_argument("--cache", action="store_true", required=False,
+                        help="keep the results of each table in a cache next to the archive and skip unchanged tables")
+    parser.add_argument("--log-file", type=Path, required=True, help="write change events to log file")
+    profile_arguments(parser)
+
+    args = parser.parse_args()
+    profile.start(args.profile, args.profile_stats)
+
+    if not (args.remove_tables or args.remove_empty_tables or args.clean_empty_columns or args.add_primary_keys):
+        parser.error("at least one operation is required")
+
+    main(args.archive, args.remove_tables, args.remove_empty_tables, args.clean_empty_columns, args.add_primary_keys,
+         args.commit, args.log_file, args.jobs, args.cache)
@@ -1,15 +1,33 @@
 from argparse import ArgumentParser
+from collections import deque
+from concurrent.futures import Future
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import wait
+from contextlib import nullcontext
 from datetime import timedelta
-from math import ceil
-from math import log10
 from pathlib import Path
+from re import Pattern
+from re import compile as re_compile
+from re import escape
 from time import perf_counter
 from typing import BinaryIO
+from typing import Iterable
+from typing import Iterator
+from typing import Optional
+from typing import TextIO
 
-from convert_qa.clean_empty_columns.main import print_with_file
+from ..common.main import Progress
+from ..common.main import file_copy_range
+from ..common.main import print_with_file
+from ..common.main import profile
+from ..common.main import profile_arguments
+from ..common.main import timed_call
 
 text_bytes: set[int] = {7, 8, 9, 10, 12, 13, 27, *range(0x20, 0x7f), *range(0x80, 0x100)}
 control_bytes: set[int] = set(range(0, 32)) - text_bytes
+control_runs_pattern: Pattern[bytes] = re_compile(
+    rb"([" + b"".join(escape(bytes([b])) for b in sorted(control_bytes)) + rb"])\1*"
+)
 
 
 def is_binary(fh: BinaryIO) -> bool:
@@ -18,59 +36,325 @@ def is_binary(fh: BinaryIO) -> bool:
     return bool(data.translate(None, bytes(text_bytes)))
 
 
-def main(file: Path, commit: bool, keep: bool, log_file: Path):
+def control_runs(chunk: bytes, offset: int = 0) -> Iterator[tuple[int, int, int]]:
+    """
+    Find the runs of consecutive identical control bytes in a chunk.
+
+    Each run is returned as its start and end (exclusive) positions, shifted by offset, and its byte.
+    Chunks without control bytes are skipped with a single translate call.
+    """
+    if len(chunk.translate(None, bytes(control_bytes))) == len(chunk):
+        return
+
+    for match in control_runs_pattern.finditer(chunk):
+        yield offset + match.start(), offset + match.end(), chunk[match.start()]
+
+
+def format_control_run(start: int, end: int, byte: int) -> str:
+    return f"{start}/{byte:02x}" if end - start == 1 else f"{start}-{end - 1}/{byte:02x}"
+
+
+def control_runs_merge(run: Optional[tuple[int, int, int]], runs: Iterable[tuple[int, int, int]]
+                       ) -> tuple[list[tuple[int, int, int]], Optional[tuple[int, int, int]]]:
+    """
+    Merge runs of control bytes with the ones that continue them.
+
+    Returns the completed runs and the last run, which may still be continued by the runs of the next chunk.
+    """
+    completed: list[tuple[int, int, int]] = []
+
+    for start, end, byte in runs:
+        if run and run[1] == start and run[2] == byte:
+            run = (run[0], end, byte)
+            continue
+        if run:
+            completed.append(run)
+        run = (start, end, byte)
+
+    return completed, run
+
+
+def clean_range(file: Path, start: int, end: int, out_path: Optional[Path], chunk_size: int = 1_000_000
+                ) -> list[tuple[int, int, int]]:
+    """
+    Remove the control characters between two offsets of a file, writing the result to out_path if given.
+
+    Returns the runs of control bytes found, with their offsets in the whole file.
+    """
+    runs: list[tuple[int, int, int]] = []
+
+    with file.open("rb") as fi, (out_path.open("wb") if out_path else nullcontext()) as fo:
+        fi.seek(start)
+        while start < end:
+            chunk: bytes = fi.read(min(chunk_size, end - start))
+            if not chunk:
+                break
+            chunk_runs: list[tuple[int, int, int]] = list(control_runs(chunk, start))
+            start += len(chunk)
+            if chunk_runs:
+                runs.extend(chunk_runs)
+                chunk = chunk.translate(None, bytes(control_bytes))
+            if fo:
+                fo.write(chunk)
+
+    return runs
+
+
+def compact_in_place(file: Path, start: int = 0, chunk_size: int = 1_000_000) -> int:
+    """
+    Remove the control characters of a file in place, starting at offset start.
+
+    The file is read and written through two cursors, the write cursor always behind the read cursor, and is then
+    truncated. Returns the new size of the file.
+    """
+    read_index: int = start
+    write_index: int = start
+
+    with file.open("r+b") as fh:
+        while True:
+            fh.seek(read_index)
+            chunk: bytes = fh.read(chunk_size)
+            if not chunk:
+                break
+            read_index += len(chunk)
+            chunk = chunk.translate(None, bytes(control_bytes))
+            fh.seek(write_index)
+            fh.write(chunk)
+            write_index += len(chunk)
+
+        fh.truncate(write_index)
+
+    return write_index
+
+
+def range_part_path(file: Path, n: int) -> Path:
+    return file.with_name(f".{file.name}.{n}.tmp")
+
+
+class RangeScheduler:
+    """
+    Submit the ranges of files for cleaning to an executor, in the order the files are added.
+
+    At most `limit` ranges are submitted ahead of the ranges that have been taken to be joined, and a new range is
+    submitted each time one is taken. The part files written ahead of the join then use a bounded amount of disk space.
+    """
+
+    def __init__(self, executor: ProcessPoolExecutor, limit: int):
+        self.executor: ProcessPoolExecutor = executor
+        self.limit: int = limit
+        self.queue: deque[tuple[Path, int, int, int, bool]] = deque()  # file, number, start, end, commit
+        self.futures: dict[tuple[Path, int], Future] = {}
+        self.files: dict[Path, int] = {}  # file: number of ranges
+        self.ahead: int = 0
+
+    def add(self, file: Path, commit: bool, range_size: int = 256_000_000) -> "FileRanges":
+        """
+        Split a file into ranges of range_size bytes. If commit is true, each range is written to a temporary part
+        file next to the original.
+        """
+        size: int = file.stat().st_size
+        ends: list[int] = []
+
+        for n, start in enumerate(range(0, size, range_size)):
+            ends.append(min(start + range_size, size))
+            self.queue.append((file, n, start, ends[-1], commit))
+
+        self.files[file] = len(ends)
+        self.fill()
+        return FileRanges(self, file, ends)
+
+    def submit(self, file: Path, n: int, start: int, end: int, commit: bool):
+        self.futures[(file, n)] = self.executor.submit(timed_call, clean_range, file, start, end,
+                                                       range_part_path(file, n) if commit else None)
+        self.ahead += 1
+
+    def fill(self):
+        while self.queue and self.ahead < self.limit:
+            self.submit(*self.queue.popleft())
+
+    def take(self, file: Path, n: int) -> Future:
+        if (file, n) not in self.futures:
+            spec: tuple[Path, int, int, int, bool] = next(s for s in self.queue if s[:2] == (file, n))
+            self.queue.remove(spec)
+            self.submit(*spec)
+        self.ahead -= 1
+        self.fill()
+        return self.futures[(file, n)]
+
+    def cancel(self, file: Path):
+        """
+        Cancel the ranges of a file, wait for those that are already running and remove their part files.
+        """
+        self.queue = deque(s for s in self.queue if s[0] != file)
+        for n in range(self.files.get(file, 0)):
+            future: Optional[Future] = self.futures.pop((file, n), None)
+            if future and not future.cancel():
+                wait([future])
+            range_part_path(file, n).unlink(missing_ok=True)
+
+    def close(self):
+        """
+        Remove the part files left by all files.
+        """
+        for file, ranges in self.files.items():
+            for n in range(ranges):
+                range_part_path(file, n).unlink(missing_ok=True)
+
+
+class FileRanges:
+    """
+    The ranges of a file added to a RangeScheduler. Iterating over them gives the end offset and the future of each
+    range, in order, and submits the following ranges.
+    """
+
+    def __init__(self, scheduler: RangeScheduler, file: Path, ends: list[int]):
+        self.scheduler: RangeScheduler = scheduler
+        self.file: Path = file
+        self.ends: list[int] = ends
+
+    def __iter__(self) -> Iterator[tuple[int, Future]]:
+        for n, end in enumerate(self.ends):
+            yield end, self.scheduler.take(self.file, n)
+
+    def cancel(self):
+        self.scheduler.cancel(self.file)
+
+
+def main(file: Path, commit: bool, keep: bool, log_file: Path, ranges: Optional[FileRanges] = None,
+         in_place: bool = False):
+    """
+    Remove the control characters of a file.
+
+    If ranges are given (see `RangeScheduler`), the file is cleaned by the executor they were submitted to, and the
+    results are logged and joined in order here, so that the log and the progress output are written by a single
+    process.
+
+    If in_place is true, the file is only scanned at first, and it is then compacted in place only if it has control
+    characters. With keep, their offsets, lengths and values are saved to a `.removed.csv` file instead of keeping a
+    copy of the original file.
+    """
     echo = print_with_file(log_file)
     file_new: Path = file.with_name("." + file.name).with_suffix(".tmp")
+    file_record: Path = file.with_name(file.name + ".removed.csv")
+    record: Optional[TextIO] = None
+    first_offset: Optional[int] = None
+    write: bool = commit and not in_place
+
+    def log_run(start: int, end: int, byte: int):
+        nonlocal record, first_offset
+        progress.clear()
+        echo(f"{file.name}/{format_control_run(start, end, byte)}",
+             event={"file": file.name, "offset": start, "length": end - start, "value": f"{byte:02x}",
+                    "action": "control character"})
+        first_offset = start if first_offset is None else first_offset
+        if in_place and commit and keep:
+            if record is None:
+                record = file_record.open("w")
+                record.write("offset,length,byte\n")
+            record.write(f"{start},{end - start},{byte:02x}\n")
 
     t1: float = perf_counter()
 
     try:
-        with file.open("rb") as fi, file_new.open("wb") as fo:
+        with file.open("rb") as fi, (file_new.open("wb") if not in_place else nullcontext()) as fo:
             if is_binary(fi):
-                echo(f"{file.name}/is binary")
+                echo(f"{file.name}/is binary", event={"file": file.name, "action": "binary"})
                 return
 
             index: int = 0
             chunk_size: int = 1_000_000
             index_max: int = file.stat().st_size
-            index_power: int = max(2, ceil(abs(log10(chunk_size / index_max))) - 2) if chunk_size < index_max else 2
-            line: str = ""
-            chunk: bytes = bytes([0] if index_max else [])
+            progress: Progress = Progress(index_max)
+            progress.update(f"{file.name}/reading")
+            chunk: bytes = bytes([0] if index_max and ranges is None else [])
+            run: Optional[tuple[int, int, int]] = None
 
+            # Runs are logged when the next one starts, so they can continue across chunks
             while chunk:
                 chunk: bytes = fi.read(chunk_size)
                 index += len(chunk)
 
-                line = f"{file.name}/reading/{(index / index_max) * 100:.0{index_power}f}%"
-                print("\r" + line, end="", flush=True)
+                progress.update(done=index)
+
+                chunk_runs: list[tuple[int, int, int]] = list(control_runs(chunk, index - len(chunk)))
 
-                if set(chunk) & control_bytes:
-                    print("\r" + (" " * len(line)) + "\r", end="", flush=True)
-                    for n, byte in filter(lambda c: c[1] in control_bytes, enumerate(chunk)):
-                        echo(f"{file.name}/{index - len(chunk) + n}/{byte:02x}")
+                if chunk_runs:
+                    runs, run = control_runs_merge(run, chunk_runs)
+                    for completed_run in runs:
+                        log_run(*completed_run)
                     chunk = chunk.translate(None, bytes(control_bytes))
-                    print(line, end="", flush=True)
 
-                if commit:
+                if write:
                     fo.write(chunk)
 
-        print("\r" + (" " * len(line)) + "\r", end="", flush=True)
+            range_start: int = 0
+
+            for n, (index, future) in enumerate(ranges or []):
+                range_runs, worker_counters = future.result()
+                profile.add(file.name, "range", bytes_read=index - range_start, **worker_counters)
+                range_start = index
+                runs, run = control_runs_merge(run, range_runs)
+                progress.update(done=index)
+
+                for completed_run in runs:
+                    log_run(*completed_run)
+
+                if write:
+                    part: Path = range_part_path(file, n)
+                    with part.open("rb") as fp:
+                        file_copy_range(fp, fo, 0)
+                    part.unlink()
+
+        progress.close()
+
+        if run:
+            log_run(*run)
+
+        profile.add(file.name, "clean", perf_counter() - t1, bytes_read=index_max,
+                    bytes_written=file_new.stat().st_size if profile and write else 0)
     except (Exception, BaseException):
         file_new.unlink(missing_ok=True)
+        if record:
+            record.close()
+            file_record.unlink(missing_ok=True)
+        if ranges is not None:
+            ranges.cancel()
         raise
 
-    if commit and file.stat().st_size != file_new.stat().st_size:
+    if in_place:
+        if record:
+            record.close()
+            echo(f"{file.name}/preserved {file_record.name}",
+                 event={"file": file.name, "action": "preserved", "value": file_record.name})
+        if commit and first_offset is not None:
+            old_size: int = file.stat().st_size
+            try:
+                with profile.phase(file.name, "compact") as counters:
+                    size: int = compact_in_place(file, first_offset)
+                    counters.update(bytes_read=old_size - first_offset, bytes_written=size - first_offset)
+            except (Exception, BaseException):
+                echo("ERROR: The operation was interrupted before all changes could be written.",
+                     f"File {file.name} is likely corrupted.", event={"file": file.name, "action": "error"})
+                raise
+            echo(f"{file.name}/saved {size}B", event={"file": file.name, "action": "saved", "value": size})
+            echo(f"{file.name}/removed {old_size - size}B",
+                 event={"file": file.name, "action": "removed", "value": old_size - size})
+    elif commit and file.stat().st_size != file_new.stat().st_size:
         size, old_size = file_new.stat().st_size, file.stat().st_size
         if keep:
             file_keep = file.replace(file.with_stem(file.stem + ".old"))
-            echo(f"\r{file.name}/preserved {file_keep.name}")
-        file_new.replace(file)
-        echo(f"\r{file.name}/saved {size}B")
-        echo(f"\r{file.name}/removed {old_size - size}B")
+            echo(f"\r{file.name}/preserved {file_keep.name}",
+                 event={"file": file.name, "action": "preserved", "value": file_keep.name})
+        with profile.phase(file.name, "replace"):
+            file_new.replace(file)
+        echo(f"\r{file.name}/saved {size}B", event={"file": file.name, "action": "saved", "value": size})
+        echo(f"\r{file.name}/removed {old_size - size}B",
+             event={"file": file.name, "action": "removed", "value": old_size - size})
     else:
         file_new.unlink(missing_ok=True)
 
-    echo(f"{file.name}/time/{timedelta(seconds=perf_counter() - t1)}")
+    echo(f"{file.name}/time/{timedelta(seconds=perf_counter() - t1)}",
+         event={"file": file.name, "action": "time", "value": perf_counter() - t1})
 
 
 def cli():
@@ -84,10 +368,36 @@ def cli():
     parser = ArgumentParser("remove-control-characters", description=cli.__doc__)
     parser.add_argument("file", type=Path, nargs="+", help="the path to the file")
     parser.add_argument("--commit", action="store_true", required=False, help="commit changes to file")
-    parser.add_argument("--keep", action="store_true", required=False, help="keep original file")
+    parser.add_argument("--keep", action="store_true", required=False,
+                        help="keep original file (or a record of the removed characters with --in-place)")
+    parser.add_argument("--in-place", action="store_true", required=False,
+                        help="scan files first and remove characters in place only from files that have any")
+    parser.add_argument("--jobs", type=int, default=1,
+                        help="number of processes used to clean files and ranges of large files in parallel")
     parser.add_argument("--log-file", type=Path, required=True, help="write change events to log file")
+    profile_arguments(parser)
 
     args = parser.parse_args()
+    profile.start(args.profile, args.profile_stats)
+
+    if args.jobs <= 1:
+        for file in args.file:
+            main(file, args.commit, args.keep, args.log_file, None, args.in_place)
+        return
+
+    executor: ProcessPoolExecutor = ProcessPoolExecutor(args.jobs)
+    # Keep two ranges per process submitted ahead of the join, so the processes are never idle while waiting for it
+    scheduler: RangeScheduler = RangeScheduler(executor, args.jobs * 2)
+    ranges: list[Optional[FileRanges]] = []
+
+    try:
+        # Add the ranges of all the text files, so small files are cleaned in parallel too
+        for file in args.file:
+            with file.open("rb") as fh:
+                ranges.append(None if is_binary(fh) else scheduler.add(file, args.commit and not args.in_place))
 
-    for file in args.file:
-        main(file, args.commit, args.keep, args.log_file)
+        for file, file_ranges in zip(args.file, ranges):
+            main(file, args.commit, args.keep, args.log_file, file_ranges, args.in_place)
+    finally:
+        executor.shutdown(cancel_futures=True)
+        scheduler.close()
@@ -2,9 +2,14 @@ from argparse import ArgumentParser
 from os import environ
 from pathlib import Path
 from sqlite3 import Connection
+from sqlite3 import Cursor
+from typing import Iterator
 
-from ..clean_empty_columns.main import print_with_file
 from ..clean_empty_columns.main import sqlite_get_tables
+from ..common.main import Progress
+from ..common.main import print_with_file
+from ..common.main import profile
+from ..common.main import profile_arguments
 
 
 def has_primary_keys(conn: Connection, table: str) -> bool:
@@ -12,13 +17,44 @@ def has_primary_keys(conn: Connection, table: str) -> bool:
 
 
 # noinspection SqlNoDataSourceInspection
-def count_rows(conn: Connection, table: str) -> int:
-    return conn.execute(f"select count(ROWID) from {table}").fetchone()[0]
+def count_duplicate_rows(conn: Connection, table: str) -> tuple[int, int]:
+    """
+    Count the rows and the unique rows of a table with a single grouped scan.
+    """
+    columns: str = ", ".join(c[1] for c in conn.execute(f"pragma table_info({table})").fetchall())
+    rows, unique_rows = conn.execute(
+        f"select coalesce(sum(n), 0), count(*) from (select count(*) as n from {table} group by {columns})"
+    ).fetchone()
+    return rows, unique_rows
 
 
 # noinspection SqlNoDataSourceInspection
-def count_unique_rows(conn: Connection, table: str) -> int:
-    return conn.execute(f"select count(*) from (select distinct * from {table})").fetchone()[0]
+def has_duplicate_rows(conn: Connection, table: str) -> bool:
+    """
+    Check if a table has at least one duplicate row, stopping at the first group of duplicates found.
+    """
+    columns: str = ", ".join(c[1] for c in conn.execute(f"pragma table_info({table})").fetchall())
+    return conn.execute(
+        f"select 1 from {table} group by {columns} having count(*) > 1 limit 1"
+    ).fetchone() is not None
+
+
+# noinspection SqlNoDataSourceInspection,SqlResolve
+def duplicate_rowids(conn: Connection, table: str) -> Iterator[int]:
+    """
+    Find the ROWIDs of the duplicate rows of a table, keeping the row with the lowest ROWID of each group.
+    """
+    columns: str = ", ".join(c[1] for c in conn.execute(f"pragma table_info({table})").fetchall())
+    cursor: Cursor = conn.execute(
+        f"select rowid from "
+        f"(select rowid, row_number() over (partition by {columns} order by rowid) as n from {table}) "
+        f"where n > 1"
+    )
+
+    try:
+        yield from (rowid for [rowid] in cursor)
+    finally:
+        cursor.close()
 
 
 # noinspection SqlNoDataSourceInspection
@@ -34,40 +70,94 @@ def remove_duplicates(conn: Connection, table: str):
     conn.execute(f"alter table {table_tmp} rename to {table}")
 
 
-def main(file: Path, commit: bool, log_file: Path):
+# noinspection SqlNoDataSourceInspection,SqlResolve
+def remove_duplicates_in_place(conn: Connection, table: str) -> int:
+    """
+    Delete the duplicate rows of a table in place, keeping the row with the lowest ROWID of each group.
+
+    The table definition, its indices and its triggers are left untouched, and only the deleted rows are written.
+    The changes are not committed, so several tables can be cleaned in one transaction.
+    """
+    rowids: list[int] = sorted(duplicate_rowids(conn, table))
+    conn.executemany(f"delete from {table} where rowid = ?", ([rowid] for rowid in rowids))
+    return len(rowids)
+
+
+def main(file: Path, commit: bool, log_file: Path, exists_only: bool = False, in_place: bool = False):
     echo = print_with_file(log_file)
 
     environ["SQLITE_TMPDIR"] = str(file.parent.resolve())
     conn = Connection(file)
     duplicate_tables: list[tuple[str, int]] = []
+    tables: list[str] = sqlite_get_tables(conn)
+    progress: Progress = Progress(len(tables), "tables")
 
-    for table in sqlite_get_tables(conn):
-        line = f"{file.name}/{table}/counting... "
-        print(line, end="", flush=True)
+    for done, table in enumerate(tables):
+        # The tables before this one are done
+        progress.update(f"{file.name}/{table}/counting", done=done)
 
         if has_primary_keys(conn, table):
-            print("\r" + (" " * len(line)) + "\r", end="", flush=True)
             continue
 
-        rows, unique_rows = count_rows(conn, table), count_unique_rows(conn, table)
-        print("\r" + (" " * len(line)) + "\r", end="", flush=True)
+        # Only the existence of duplicates is needed, so the check can stop at the first one
+        if exists_only and not commit:
+            with profile.phase(f"{file.name}/{table}", "check"):
+                duplicates_found: bool = has_duplicate_rows(conn, table)
+            if duplicates_found:
+                progress.clear()
+                echo(f"{file.name}/{table}/duplicates: yes",
+                     event={"file": file.name, "table": table, "action": "duplicates"})
+            continue
+
+        with profile.phase(f"{file.name}/{table}", "count") as counters:
+            rows, unique_rows = count_duplicate_rows(conn, table)
+            counters["rows"] = rows
 
         if rows != unique_rows:
-            echo(f"{file.name}/{table}/duplicates: {rows - unique_rows} ({rows}, {unique_rows})")
+            progress.clear()
+            echo(f"{file.name}/{table}/duplicates: {rows - unique_rows} ({rows}, {unique_rows})",
+                 event={"file": file.name, "table": table, "action": "duplicates", "value": rows - unique_rows})
             duplicate_tables.append((table, rows - unique_rows))
 
+    progress.close()
+
     if commit and duplicate_tables:
+        progress = Progress(len(duplicate_tables), "tables")
+
         try:
             for table, duplicates in duplicate_tables:
-                print(f"{file.name}/{table}/cleaning... ", end="", flush=True)
-                remove_duplicates(conn, table)
-                echo(f"\r{file.name}/{table}/removed {duplicates} duplicates")
+                progress.update(f"{file.name}/{table}/cleaning")
+                with profile.phase(f"{file.name}/{table}", "remove") as counters:
+                    if in_place:
+                        duplicates = remove_duplicates_in_place(conn, table)
+                    else:
+                        remove_duplicates(conn, table)
+                    counters["rows"] = duplicates
+                progress.update(advance=1)
+                progress.clear()
+                echo(f"{file.name}/{table}/removed {duplicates} duplicates",
+                     event={"file": file.name, "table": table, "action": "removed", "value": duplicates})
+
+            progress.close()
+
+            if in_place:
+                conn.commit()
+                return
 
             line = f"{file.name}/vacuuming... "
             print(line, end="", flush=True)
             conn.commit()
-            conn.execute("vacuum")
+            with profile.phase(file.name, "vacuum") as counters:
+                counters["bytes_read"] = file.stat().st_size if profile else 0
+                conn.execute("vacuum")
+                counters["bytes_written"] = file.stat().st_size if profile else 0
             print("\r" + (" " * len(line)) + "\r", end="", flush=True)
+        except BaseException:
+            # The in-place deletes of all tables are one transaction, so none of them are kept if one fails
+            if in_place:
+                conn.rollback()
+                echo("ERROR: Changes interrupted before committing", event={"file": file.name, "action": "error"})
+            raise
         finally:
             conn.commit()
 
@@ -80,9 +170,15 @@ def cli():
     parser = ArgumentParser("remove-duplicate-rows", description=cli.__doc__)
     parser.add_argument("file", type=Path, nargs="+", help="the path to the database file")
     parser.add_argument("--commit", action="store_true", required=False, help="commit changes to database")
+    parser.add_argument("--exists-only", action="store_true", required=False,
+                        help="only check which tables have duplicates without counting them (ignored with --commit)")
+    parser.add_argument("--in-place", action="store_true", required=False,
+                        help="delete duplicate rows in place, keeping the tables' definitions and skipping the vacuum")
     parser.add_argument("--log-file", type=Path, required=True, help="write change events to log file")
+    profile_arguments(parser)
 
     args = parser.parse_args()
+    profile.start(args.profile, args.profile_stats)
 
     for file in args.file:
-        main(file, args.commit, args.log_file)
+        main(file, args.commit, args.log_file, args.exists_only, args.in_place)
@@ -1,19 +1,47 @@
 from argparse import ArgumentParser
+from concurrent.futures import Future
+from concurrent.futures import ProcessPoolExecutor
 from functools import reduce
 from pathlib import Path
+from sqlite3 import Connection
 from typing import Optional
 
 from xmltodict import parse as parse_xml
 
-from ..clean_empty_columns.main import print_with_file
 from ..clean_empty_columns.main import rmdir
+from ..clean_empty_columns.main import table_cache_connect
+from ..clean_empty_columns.main import table_cache_get
+from ..clean_empty_columns.main import table_cache_path
+from ..clean_empty_columns.main import table_cache_update
 from ..clean_empty_columns.main import table_index_update
 from ..clean_empty_columns.main import table_xml_update
 from ..clean_empty_columns.main import table_xsd_update
+from ..common.main import Progress
+from ..common.main import print_with_file
+from ..common.main import profile
+from ..common.main import profile_arguments
+from ..common.main import timed_call
+
+
+def table_move(table_folder: Path, new_index: int) -> Path:
+    """
+    Renumber the XML and XSD files of a table and move its folder to a temporary name (.tableN).
+
+    The temporary names cannot collide with the folders of other tables, so tables can be moved in any order.
+    """
+    xml_path: Path = table_folder.joinpath(table_folder.name).with_suffix(".xml")
+    table_xml_update(xml_path, new_index, [], xml_path)
+    xml_path.rename(xml_path.with_name(f"table{new_index}.xml"))
+
+    xsd_path: Path = table_folder.joinpath(table_folder.name).with_suffix(".xsd")
+    table_xsd_update(xsd_path, new_index, [], xsd_path)
+    xsd_path.rename(xsd_path.with_name(f"table{new_index}.xsd"))
+
+    return table_folder.rename(table_folder.with_name(f".table{new_index}"))
 
 
 # noinspection DuplicatedCode
-def main(archive: Path, table_names: list[str], log_file: Optional[Path]):
+def main(archive: Path, table_names: list[str], log_file: Optional[Path], jobs: int = 1, cache: bool = False):
     echo = print_with_file(log_file)
     table_names = list(map(str.lower, table_names))
 
@@ -30,54 +58,109 @@ def main(archive: Path, table_names: list[str], log_file: Optional[Path]):
     tables_to_remove = [ti for ti in tables_to_remove if ti in table_ids]
 
     if not tables_to_remove:
-        echo(f"{archive.name}/no tables to remove")
+        echo(f"{archive.name}/no tables to remove", event={"file": archive.name, "action": "not modified"})
         return
 
+    moves: dict[int, Future] = {}
+    executor: Optional[ProcessPoolExecutor] = ProcessPoolExecutor(jobs) if jobs > 1 else None
+    cache_conn: Optional[Connection] = table_cache_connect(table_cache_path(archive)) if cache else None
+    tables_stats: dict[int, tuple[list[str], set[str], Optional[int]]] = {}
+
+    moved_sizes: dict[int, int] = {}
+
+    # Read the sizes and the cached statistics of the tables that are moved before their files are changed
+    for table in tables:
+        index = int(table["folder"].removeprefix("table"))
+        xml_path: Path = archive.joinpath("tables", table["folder"], f"{table['folder']}.xml")
+        if index > min(tables_to_remove) and index not in tables_to_remove:
+            moved_sizes[index] = xml_path.stat().st_size if xml_path.is_file() else 0
+            entry = table_cache_get(cache_conn, xml_path) if cache_conn else None
+            if entry:
+                tables_stats[index] = entry
+
     try:
+        # Start moving the tables in parallel, each folder is moved to a temporary name
+        for table in (tables if executor else []):
+            index = int(table["folder"].removeprefix("table"))
+            table_folder: Path = archive.joinpath("tables", table["folder"])
+            index_diff: int = reduce(lambda p, c: (p + 1) if c < index else p, tables_to_remove, 0)
+
+            if index not in tables_to_remove and index_diff and table_folder.is_dir():
+                moves[index] = executor.submit(timed_call, table_move, table_folder, index - index_diff)
+
+        staged: list[Path] = []
+        progress: Progress = Progress(sum(moved_sizes.values()))
+
         for table in sorted(tables, key=lambda t: int(t["folder"].removeprefix("table"))):
             index = int(table["folder"].removeprefix("table"))
             table_folder: Path = archive.joinpath("tables", table["folder"])
 
             if index in tables_to_remove:
-                echo(f"{archive.name}/{table['folder']}/{table['name']}/removed")
-                rmdir(archive.joinpath("tables", table["folder"]))
+                progress.clear()
+                echo(f"{archive.name}/{table['folder']}/{table['name']}/removed",
+                     event={"file": archive.name, "table": table["folder"], "action": "removed"})
+                with profile.phase(f"{archive.name}/{table['folder']}", "remove"):
+                    rmdir(archive.joinpath("tables", table["folder"]))
                 continue
             elif index <= min(tables_to_remove, default=-1):
                 continue
-            elif not table_folder.is_dir():
-                echo(f"{archive.name}/{table['folder']}/{table['name']}/folder not found")
+            elif index not in moves and not table_folder.is_dir():
+                progress.clear()
+                echo(f"{archive.name}/{table['folder']}/{table['name']}/folder not found",
+                     event={"file": archive.name, "table": table["folder"], "action": "not found"})
                 continue
 
             index_diff: int = reduce(lambda p, c: (p + 1) if c < index else p, tables_to_remove, 0)
             new_index: int = index - index_diff
 
             if not index_diff:
-                echo(f"{archive.name}/{table['folder']}/{table['name']}/not modified")
+                progress.clear()
+                echo(f"{archive.name}/{table['folder']}/{table['name']}/not modified",
+                     event={"file": archive.name, "table": table["folder"], "action": "not modified"})
                 continue
 
-            print(f"{archive.name}/{table['folder']}/{table['name']}/moving to table{new_index}", end="", flush=True)
-
-            xml_path: Path = table_folder.joinpath(table["folder"]).with_suffix(".xml")
-            xml_path_tmp = table_xml_update(xml_path, new_index, [], xml_path.with_name("." + xml_path.name))
-            xml_path.unlink(missing_ok=True)
-            xml_path_tmp.rename(xml_path.with_name(f"table{new_index}.xml"))
-
-            xsd_path: Path = table_folder.joinpath(table["folder"]).with_suffix(".xsd")
-            table_xsd_update(xsd_path, new_index, [], xsd_path)
-            xsd_path.rename(xsd_path.with_name(f"table{new_index}.xsd"))
-
-            if new_index != index:
-                xml_path.parent.rename(xml_path.parent.with_name(f"table{new_index}"))
-
-            echo(f"\r{archive.name}/{table['folder']}/{table['name']}/moved to table{new_index}   ")
-
-        table_index_update(tables_index_path, [], tables_to_remove, tables_index_path)
+            progress.update(f"{archive.name}/{table['folder']}/{table['name']}/moving to table{new_index}")
+
+            with profile.phase(f"{archive.name}/{table['folder']}", "move") as counters:
+                if index in moves:
+                    moved_folder, worker_counters = moves[index].result()
+                    staged.append(moved_folder)
+                    counters.update(worker_counters)
+                else:
+                    staged.append(table_move(table_folder, new_index))
+                if profile:
+                    counters["bytes_written"] = sum(f.stat().st_size for f in staged[-1].iterdir() if f.is_file())
+
+            progress.update(advance=moved_sizes.get(index, 0))
+            progress.clear()
+            echo(f"{archive.name}/{table['folder']}/{table['name']}/moved to table{new_index}",
+                 event={"file": archive.name, "table": table["folder"], "action": "moved",
+                        "value": f"table{new_index}"})
+
+        progress.close()
+
+        # Move the folders from their temporary names to their final names
+        with profile.phase(archive.name, "rename"):
+            for table_folder in staged:
+                table_folder.rename(table_folder.with_name(table_folder.name.removeprefix(".")))
+
+        with profile.phase(archive.name, "index"):
+            table_index_update(tables_index_path, [], tables_to_remove, tables_index_path)
+
+        if cache_conn:
+            with profile.phase(archive.name, "cache"):
+                table_cache_update(cache_conn, archive, tables_stats, [], tables_to_remove)
     except (Exception, BaseException) as err:
         print()
         echo("ERROR: The operation was interrupted before all changes could be written.",
-             f"Archive {archive.name} is likely corrupted.")
+             f"Archive {archive.name} is likely corrupted.", event={"file": archive.name, "action": "error"})
         print()
         raise err
+    finally:
+        if executor:
+            executor.shutdown(cancel_futures=True)
+        if cache_conn:
+            cache_conn.close()
 
 
 def cli():
@@ -92,9 +175,14 @@ def cli():
     tables_action = tables_group.add_argument("tables", nargs="*", default=[], help="the tables to remove")
     empty_tables_action = tables_group.add_argument("--empty-tables", action="store_true",
                                                     help="remove all empty tables")
+    parser.add_argument("--jobs", type=int, default=1, help="number of tables to move in parallel")
+    parser.add_argument("--cache", action="store_true", required=False,
+                        help="keep the statistics cache next to the archive up to date")
     parser.add_argument("--log-file", type=Path, required=True, help="write change events to log file")
+    profile_arguments(parser)
 
     args = parser.parse_args()
+    profile.start(args.profile, args.profile_stats)
 
     if not args.tables and not args.empty_tables:
         parser.error(
@@ -103,4 +191,4 @@ def cli():
             f"{empty_tables_action.option_strings[0]}")
         return parser.exit(2)
 
-    main(args.archive, args.tables or [], args.log_file)
+    main(args.archive, args.tables or [], args.log_file, args.jobs, args.cache)